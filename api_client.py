@@ -2,7 +2,9 @@ import asyncio
 import logging
 from typing import Dict, Any, Optional, Tuple
 import aiohttp
-import json
+
+from http_session import get_session
+from util import fastjson
 
 log = logging.getLogger(__name__)
 
@@ -10,10 +12,19 @@ log = logging.getLogger(__name__)
 class LockAPIClient:
     """Client for communicating with the lock control REST API"""
     
-    def __init__(self, api_base_url: str = "http://localhost:8080"):
+    JSON_HEADERS = {'Content-Type': 'application/json'}
+    
+    def __init__(self, api_base_url: str = "http://localhost:8080", session: Optional[aiohttp.ClientSession] = None):
         self.api_base_url = api_base_url.rstrip('/')
+        self._session = session
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Get the injected session, or the one shared on the running event loop"""
+        if self._session is not None:
+            return self._session
+        return await get_session()
         
-    async def initiate_lock_activation(self, issuer_id: str) -> Optional[Tuple[int, list[int]]]:
+    async def initiate_lock_activation(self, issuer_id: str) -> Optional[Tuple[int, bytes]]:
         """
         Initiate lock activation sequence.
         
@@ -25,41 +36,41 @@ class LockAPIClient:
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.api_base_url}/_r/homekey_authenticated",
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=10)
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
+            session = await self._get_session()
+            async with session.post(
+                f"{self.api_base_url}/_r/homekey_authenticated",
+                data=fastjson.dumps(payload),
+                headers=self.JSON_HEADERS,
+            ) as response:
+                if response.status == 200:
+                    data = fastjson.loads(await response.read())
+                    
+                    # Expected response format:
+                    # {
+                    #   "tag": "initiate_bluetooth_connection",
+                    #   "data": {
+                    #     "serial": 12345,
+                    #     "message": [0x01, 0x02, 0x03, ...]
+                    #   }
+                    # }
+                    
+                    if data.get("tag") == "initiate_bluetooth_connection":
+                        connection_data = data.get("data", {})
+                        serial = connection_data.get("serial")
+                        message = connection_data.get("message", [])
                         
-                        # Expected response format:
-                        # {
-                        #   "tag": "initiate_bluetooth_connection",
-                        #   "data": {
-                        #     "serial": 12345,
-                        #     "message": [0x01, 0x02, 0x03, ...]
-                        #   }
-                        # }
-                        
-                        if data.get("tag") == "initiate_bluetooth_connection":
-                            connection_data = data.get("data", {})
-                            serial = connection_data.get("serial")
-                            message = connection_data.get("message", [])
+                        if serial is not None and message:
+                            log.info(f"API returned initiation data for serial {serial}")
+                            return serial, bytes(message)
                             
-                            if serial is not None and message:
-                                log.info(f"API returned initiation data for serial {serial}")
-                                return serial, message
-                                
-                        log.error(f"Unexpected API response format: {data}")
-                        return None
-                        
-                    else:
-                        log.error(f"API request failed with status {response.status}")
-                        response_text = await response.text()
-                        log.error(f"Response: {response_text}")
-                        return None
+                    log.error(f"Unexpected API response format: {data}")
+                    return None
+                    
+                else:
+                    log.error(f"API request failed with status {response.status}")
+                    response_text = await response.text()
+                    log.error(f"Response: {response_text}")
+                    return None
                         
         except asyncio.TimeoutError:
             log.error("API request timed out")
@@ -68,4 +79,3 @@ class LockAPIClient:
             log.error(f"Error calling lock activation API: {e}")
             return None
             
- 
\ No newline at end of file
@@ -1,4 +1,3 @@
-import copy
 import hashlib
 import json
 import logging
@@ -8,8 +7,10 @@ import asyncio
 import aiohttp
 from typing import List, Optional
 
-from entity import Endpoint, Issuer
+from entity import KEY_IDENTIFIER_PREFIX, Endpoint, Issuer
+from http_session import close_session, get_session
 from repository import Repository
+from util import fastjson
 
 log = logging.getLogger()
 
@@ -19,6 +20,12 @@ class APIRepository(Repository):
 
     _issuers: List[Issuer]
 
+    # Periodic reads back off while the API state stays unchanged
+    READ_INTERVAL = 60.0
+    MAX_READ_INTERVAL = 600.0
+    # Mutations within this window are coalesced into a single save
+    SAVE_DELAY = 0.05
+
     def __init__(self, api_base_url: str, api_secret: Optional[str] = None, read_endpoint: str = "/_r/homekey_state_requested", store_endpoint: str = "/_r/homekey_state_updated"):
         # Don't call super().__init__ since we don't need file-based storage
         self.api_base_url = api_base_url.rstrip('/')
@@ -27,137 +34,298 @@ class APIRepository(Repository):
         self.store_endpoint = store_endpoint
         self.read_url = f"{self.api_base_url}{self.read_endpoint}"
         self.store_url = f"{self.api_base_url}{self.store_endpoint}"
+        self._headers = {'Content-Type': 'application/json'}
+        if self.api_secret:
+            self._headers['Authorization'] = f"Bearer {self.api_secret}"
         
         self._reader_private_key = bytes.fromhex("00" * 32)
         self._reader_identifier = bytes.fromhex("00" * 8)
+        self._reader_group_identifier: Optional[bytes] = None
         self._issuers = list()
+        self._index_issuers(self._issuers)
         self._transaction_lock = threading.Lock()
         self._state_lock = threading.Lock()
         
+        # Long-lived event loop, its shared session is used by all API requests
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+        self._save_lock: Optional[asyncio.Lock] = None
+        self._saved_digest: Optional[bytes] = None
+        self._start_event_loop()
+
         # Periodic reading setup
-        self._read_timer = None
-        self._stop_reading = threading.Event()
+        self._read_task: Optional[asyncio.Task] = None
+        self._state_digest: Optional[bytes] = None
+        self._generation = 0
+        self._saved_generation = 0
         
         # Initial data load
         self._load_state_from_api()
         self._start_periodic_reading()
 
-    def _run_async_safely(self, coro):
-        """Safely run async code regardless of whether we're in an event loop"""
+    def _start_event_loop(self):
+        """Start the background event loop that all API requests run on"""
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+
+    def _stop_event_loop(self):
+        """Close the shared session and stop the background event loop"""
+        loop = getattr(self, '_loop', None)
+        if loop is None or loop.is_closed():
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            log.warning(f"Failed to save pending changes to API: {e}")
         try:
-            # Check if there's already a running event loop
-            loop = asyncio.get_running_loop()
-            # If we get here, there's a running loop, so we need to run in a thread
-            import concurrent.futures
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(asyncio.run, coro)
-                return future.result()
-        except RuntimeError:
-            # No running event loop, we can use asyncio.run safely
-            return asyncio.run(coro)
+            self._run_async_safely(close_session(), timeout=5)
+        except Exception as e:
+            log.warning(f"Failed to close API session: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        self._loop_thread.join(timeout=5)
+        loop.close()
+
+    def _run_async_safely(self, coro, timeout: float = 15):
+        """Run a coroutine on the background event loop and wait for its result"""
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        return future.result(timeout=timeout)
 
     def _start_periodic_reading(self):
-        """Start periodic reading from API every minute"""
-        def _periodic_read():
-            while not self._stop_reading.wait(60):  # Read every minute
-                try:
-                    self._load_state_from_api()
-                except Exception as e:
-                    log.warning(f"Failed to read from API during periodic update: {e}")
-        
-        self._read_thread = threading.Thread(target=_periodic_read, daemon=True)
-        self._read_thread.start()
+        """Start periodic reading from API on the background loop"""
+        self._read_task = self._run_async_safely(self._async_start_periodic_reading())
+
+    async def _async_start_periodic_reading(self) -> asyncio.Task:
+        return asyncio.create_task(self._periodic_read())
 
     def _stop_periodic_reading(self):
-        """Stop periodic reading"""
-        self._stop_reading.set()
-        if hasattr(self, '_read_thread'):
-            self._read_thread.join(timeout=5)
+        """Stop periodic reading and wait for the reader task to finish"""
+        if self._read_task is not None:
+            try:
+                self._run_async_safely(self._async_stop_periodic_reading(self._read_task), timeout=5)
+            except Exception as e:
+                log.warning(f"Failed to stop periodic reading: {e}")
+            self._read_task = None
+
+    @staticmethod
+    async def _async_stop_periodic_reading(task: asyncio.Task):
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
 
-    def _load_state_from_api(self):
-        """Load state from API endpoint using POST request"""
+    async def _periodic_read(self):
+        """Read from API periodically, backing off while the state stays unchanged"""
+        interval = self.READ_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changed = await self._async_reload_state()
+            except Exception as e:
+                log.warning(f"Failed to read from API during periodic update: {e}")
+                continue
+            # Failed or skipped reads keep the interval, only an unchanged state backs off
+            if changed:
+                interval = self.READ_INTERVAL
+            elif changed is not None:
+                interval = min(interval * 2, self.MAX_READ_INTERVAL)
+
+    def close(self):
+        """Save pending changes, stop periodic reading and release the event loop"""
+        self._stop_periodic_reading()
+        self._stop_event_loop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _load_state_from_api(self) -> Optional[bool]:
+        """Load state from API endpoint using POST request, returns whether it changed"""
+        return self._run_async_safely(self._async_reload_state())
+
+    async def _async_reload_state(self) -> Optional[bool]:
+        """Load state from API on the background loop, returns whether it changed or None if it wasn't read"""
         try:
-            with self._state_lock:
-                configuration = self._run_async_safely(self._async_load_state())
-                if configuration is not None:
-                    self._reader_private_key = bytes.fromhex(
-                        configuration.get("reader_private_key", "00" * 32)
-                    )
-                    self._reader_identifier = bytes.fromhex(
-                        configuration.get("reader_identifier", "00" * 8)
-                    )
-                    self._issuers = [
-                        Issuer.from_dict(issuer)
-                        for _, issuer in configuration.get("issuers", {}).items()
-                    ]
-                    log.debug("Successfully loaded state from API")
+            # The request runs without holding any lock so mutations aren't blocked on it
+            generation = self._generation
+            if generation != self._saved_generation:
+                log.debug("Skipping read from API while local changes are being saved")
+                return None
+            body = await self._async_load_state()
+            if body is None:
+                return None
+            digest = hashlib.sha256(body).digest()
+            if digest == self._state_digest:
+                log.debug("State from API is unchanged")
+                return False
+            configuration = fastjson.loads(body)
+            issuers = [
+                Issuer.from_dict(issuer)
+                for _, issuer in configuration.get("issuers", {}).items()
+            ]
+            with self._transaction_lock, self._state_lock:
+                if generation != self._generation:
+                    # State was saved while the request was in flight, so the response is outdated
+                    log.debug("Discarding state from API as it was modified locally")
+                    return None
+                self._reader_private_key = bytes.fromhex(
+                    configuration.get("reader_private_key", "00" * 32)
+                )
+                self._reader_group_identifier = None
+                self._reader_identifier = bytes.fromhex(
+                    configuration.get("reader_identifier", "00" * 8)
+                )
+                self._index_issuers(issuers)
+                self._state_digest = digest
+                # The API may no longer hold what was saved last, so the next save must not be skipped
+                self._saved_digest = None
+            log.debug("Successfully loaded state from API")
+            return True
+        except json.JSONDecodeError as e:
+            log.error(f"Invalid JSON response from API: {e}")
         except Exception as e:
             log.exception(f"Unexpected error loading from API: {e}")
+        return None
 
-    async def _async_load_state(self):
-        """Async helper to load state from API"""
+    async def _async_load_state(self) -> Optional[bytes]:
+        """Async helper to load the raw state body from API"""
         try:
-            timeout = aiohttp.ClientTimeout(total=10)
-            headers = {'Content-Type': 'application/json'}
-            if self.api_secret:
-                headers['Authorization'] = f"Bearer {self.api_secret}"
-            
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(
-                    self.read_url,
-                    json={},
-                    headers=headers
-                ) as response:
-                    response.raise_for_status()
-                    return await response.json()
+            session = await get_session()
+            async with session.post(
+                self.read_url,
+                json={},
+                headers=self._headers
+            ) as response:
+                response.raise_for_status()
+                return await response.read()
         except aiohttp.ClientError as e:
             log.warning(f"Could not load Home Key configuration from API: {e}")
             return None
-        except json.JSONDecodeError as e:
-            log.error(f"Invalid JSON response from API: {e}")
-            return None
 
-    def _save_state_to_api(self):
-        """Save state to API endpoint using POST request"""
-        try:
-            with self._state_lock:
-                data = {
-                    "reader_private_key": self._reader_private_key.hex(),
-                    "reader_identifier": self._reader_identifier.hex(),
-                    "issuers": {
-                        issuer.id.hex(): issuer.to_dict() for issuer in self._issuers
-                    },
-                }
-                
-                success = self._run_async_safely(self._async_save_state(data))
-                if success:
+    def _schedule_save(self):
+        """(Re)start the save timer; must be called from the background loop"""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+        self._save_handle = self._loop.call_later(self.SAVE_DELAY, self._flush_save)
+
+    def _flush_save(self):
+        """Save timer callback, runs the pending save on the background loop"""
+        self._save_handle = None
+        self._loop.create_task(self._save_state_to_api())
+
+    def flush(self):
+        """Save any pending changes to the API immediately, does nothing if there are none"""
+        async def _flush():
+            if self._save_handle is None and self._generation == self._saved_generation:
+                # Nothing changed locally, saving would overwrite newer edits made by other clients
+                return
+            if self._save_handle is not None:
+                self._save_handle.cancel()
+                self._save_handle = None
+            await self._save_state_to_api()
+
+        self._run_async_safely(_flush())
+
+    async def _save_state_to_api(self):
+        """Save state to API endpoint using POST request, skipped if nothing has changed"""
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            try:
+                with self._transaction_lock:
+                    generation = self._generation
+                    data = {
+                        "reader_private_key": self._reader_private_key.hex(),
+                        "reader_identifier": self._reader_identifier.hex(),
+                        "issuers": {
+                            issuer.id_hex: issuer.to_dict_cached() for issuer in self._issuers
+                        },
+                    }
+
+                body = fastjson.dumps(data)
+                digest = hashlib.sha256(body).digest()
+                if digest != self._saved_digest and await self._async_save_state(body):
+                    self._saved_digest = digest
                     log.debug("Successfully saved state to API")
-        except Exception as e:
-            log.exception(f"Unexpected error saving to API: {e}")
+            except Exception as e:
+                log.exception(f"Unexpected error saving to API: {e}")
+            # Even if saving failed, allow later reads from the API to replace local state again
+            self._saved_generation = max(self._saved_generation, generation)
 
-    async def _async_save_state(self, data):
-        """Async helper to save state to API"""
+    async def _async_save_state(self, body: bytes):
+        """Async helper to save serialized state to API"""
         try:
-            timeout = aiohttp.ClientTimeout(total=10)
-            headers = {'Content-Type': 'application/json'}
-            if self.api_secret:
-                headers['Authorization'] = f"Bearer {self.api_secret}"
-            
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(
-                    self.store_url,
-                    json=data,
-                    headers=headers
-                ) as response:
-                    response.raise_for_status()
-                    return True
+            session = await get_session()
+            async with session.post(
+                self.store_url,
+                data=body,
+                headers=self._headers
+            ) as response:
+                response.raise_for_status()
+                return True
         except aiohttp.ClientError as e:
             log.error(f"Could not save Home Key configuration to API: {e}")
             return False
 
+    def _index_issuers(self, issuers: List[Issuer]):
+        """Replace the issuer list and rebuild all lookup indexes from it"""
+        issuers_by_id = {issuer.id: issuer for issuer in issuers}
+        endpoints = [
+            (issuer_id, endpoint)
+            for issuer_id, issuer in issuers_by_id.items()
+            for endpoint in issuer.endpoints
+        ]
+        self._issuers_by_public_key = {
+            issuer.public_key: issuer for issuer in issuers_by_id.values()
+        }
+        self._endpoints_by_id = {endpoint.id: endpoint for _, endpoint in endpoints}
+        self._endpoints_by_public_key = {
+            endpoint.public_key: endpoint for _, endpoint in endpoints
+        }
+        self._issuer_id_by_endpoint_id = {
+            endpoint.id: issuer_id for issuer_id, endpoint in endpoints
+        }
+        self._issuers_by_id = issuers_by_id
+        self._issuers = list(issuers_by_id.values())
+
+    def _index_issuer(self, issuer: Issuer):
+        """Add an issuer and its endpoints to the lookup indexes"""
+        self._issuers_by_id[issuer.id] = issuer
+        self._issuers_by_public_key[issuer.public_key] = issuer
+        for endpoint in issuer.endpoints:
+            self._index_endpoint(issuer.id, endpoint)
+
+    def _unindex_issuer(self, issuer: Issuer):
+        """Remove an issuer and its endpoints from the lookup indexes"""
+        self._issuers_by_id.pop(issuer.id, None)
+        self._issuers_by_public_key.pop(issuer.public_key, None)
+        self._unindex_endpoints(issuer)
+
+    def _unindex_endpoints(self, issuer: Issuer):
+        """Remove the endpoints of an issuer from the lookup indexes"""
+        for endpoint in issuer.endpoints:
+            self._endpoints_by_id.pop(endpoint.id, None)
+            self._endpoints_by_public_key.pop(endpoint.public_key, None)
+            self._issuer_id_by_endpoint_id.pop(endpoint.id, None)
+
+    def _index_endpoint(self, issuer_id: bytes, endpoint: Endpoint):
+        """Add an endpoint to the lookup indexes"""
+        self._endpoints_by_id[endpoint.id] = endpoint
+        self._endpoints_by_public_key[endpoint.public_key] = endpoint
+        self._issuer_id_by_endpoint_id[endpoint.id] = issuer_id
+
+    def _put_issuer(self, issuer: Issuer):
+        """Insert or replace an issuer by id, keeping indexes up to date"""
+        existing = self._issuers_by_id.get(issuer.id)
+        if existing is not None:
+            # Keep the issuer's key in place so it retains its position in the list
+            self._unindex_endpoints(existing)
+        self._index_issuer(issuer)
+
     def _refresh_state(self):
-        """Save state to API (no need to reload since we have the latest state)"""
-        self._save_state_to_api()
+        """Schedule a save to API (no need to reload since we have the latest state)"""
+        # Called with the transaction lock held, lets in-flight loads detect they are outdated
+        self._generation += 1
+        self._loop.call_soon_threadsafe(self._schedule_save)
 
     def get_reader_private_key(self):
         return self._reader_private_key
@@ -165,6 +333,7 @@ class APIRepository(Repository):
     def set_reader_private_key(self, reader_private_key):
         with self._transaction_lock:
             self._reader_private_key = reader_private_key
+            self._reader_group_identifier = None
             self._refresh_state()
 
     def get_reader_identifier(self):
@@ -176,98 +345,88 @@ class APIRepository(Repository):
             self._refresh_state()
 
     def get_reader_group_identifier(self):
-        return (
-            hashlib.sha256("key-identifier".encode() + self.get_reader_private_key())
-        ).digest()[:8]
+        if self._reader_group_identifier is None:
+            self._reader_group_identifier = hashlib.sha256(
+                KEY_IDENTIFIER_PREFIX + self.get_reader_private_key()
+            ).digest()[:8]
+        return self._reader_group_identifier
 
     def get_all_issuers(self):
-        return copy.deepcopy([i for i in self._issuers])
+        return [i.clone() for i in self._issuers]
 
     def get_all_endpoints(self):
-        return copy.deepcopy(
-            [endpoint for issuer in self._issuers for endpoint in issuer.endpoints]
-        )
+        return [
+            endpoint.clone()
+            for issuer in self._issuers
+            for endpoint in issuer.endpoints
+        ]
 
     def get_endpoint_by_public_key(self, public_key: bytes) -> Optional[Endpoint]:
-        return next(
-            (
-                endpoint
-                for endpoint in self.get_all_endpoints()
-                if endpoint.public_key == public_key
-            ),
-            None,
-        )
+        endpoint = self._endpoints_by_public_key.get(public_key)
+        return endpoint.clone() if endpoint is not None else None
 
     def get_endpoint_by_id(self, id) -> Optional[Endpoint]:
-        return next(
-            (endpoint for endpoint in self.get_all_endpoints() if endpoint.id == id),
-            None,
-        )
+        endpoint = self._endpoints_by_id.get(id)
+        return endpoint.clone() if endpoint is not None else None
 
     def get_issuer_by_public_key(self, public_key) -> Optional[Issuer]:
-        return next(
-            (
-                issuer
-                for issuer in self.get_all_issuers()
-                if issuer.public_key == public_key
-            ),
-            None,
-        )
+        issuer = self._issuers_by_public_key.get(public_key)
+        return issuer.clone() if issuer is not None else None
 
     def get_issuer_by_id(self, id) -> Optional[Issuer]:
-        return next(
-            (issuer for issuer in self.get_all_issuers() if issuer.id == id), None
-        )
+        issuer = self._issuers_by_id.get(id)
+        return issuer.clone() if issuer is not None else None
 
     def get_issuer_by_endpoint(self, endpoint: Endpoint) -> Optional[Issuer]:
-        return next(
-            (issuer for issuer in self.get_all_issuers() 
-             if any(ep.id == endpoint.id for ep in issuer.endpoints)), None
-        )
+        issuer_id = self._issuer_id_by_endpoint_id.get(endpoint.id)
+        return self.get_issuer_by_id(issuer_id) if issuer_id is not None else None
 
     def remove_issuer(self, issuer: Issuer):
         with self._transaction_lock:
-            issuers = [i for i in copy.deepcopy(self._issuers) if i.id != issuer.id]
-            self._issuers = issuers
+            existing = self._issuers_by_id.get(issuer.id)
+            if existing is not None:
+                self._unindex_issuer(existing)
+            self._issuers = list(self._issuers_by_id.values())
             self._refresh_state()
 
     def upsert_issuer(self, issuer: Issuer):
         with self._transaction_lock:
-            issuer = copy.deepcopy(issuer)
-            issuers = [
-                (i if i.id != issuer.id else issuer)
-                for i in copy.deepcopy(self._issuers)
-            ]
-            if issuer not in issuers:
-                issuers.append(issuer)
-            self._issuers = issuers
+            self._put_issuer(issuer.clone())
+            self._issuers = list(self._issuers_by_id.values())
             self._refresh_state()
 
     def upsert_endpoint(self, issuer_id, endpoint: Endpoint):
         with self._transaction_lock:
-            issuer = next(
-                (issuer for issuer in self._issuers if issuer.id == issuer_id), None
-            )
+            issuer = self._issuers_by_id.get(issuer_id)
             if issuer is None:
                 return
+            endpoint = endpoint.clone()
             endpoints = [
                 (e if e.id != endpoint.id else endpoint) for e in issuer.endpoints
             ]
             if endpoint not in endpoints:
                 endpoints.append(endpoint)
             issuer.endpoints = endpoints
+            issuer.invalidate_cache()
+            self._index_endpoint(issuer.id, endpoint)
             self._refresh_state()
 
     def upsert_issuers(self, issuers: List[Issuer]):
-        issuers_dict = {issuer.id: copy.deepcopy(issuer) for issuer in issuers}
+        issuers_dict = {issuer.id: issuer.clone() for issuer in issuers}
         with self._transaction_lock:
-            iss = [issuers_dict.get(i.id, i) for i in copy.deepcopy(self._issuers)]
             for issuer in issuers_dict.values():
-                if issuer not in iss:
-                    iss.append(issuer)
-            self._issuers = iss
+                self._put_issuer(issuer)
+            self._issuers = list(self._issuers_by_id.values())
             self._refresh_state()
 
-    def __del__(self):
-        """Cleanup periodic reading on destruction"""
-        self._stop_periodic_reading() 
\ No newline at end of file
+    def apply_issuer_changes(self, added: List[Issuer], removed: List[Issuer]):
+        added_dict = {issuer.id: issuer.clone() for issuer in added}
+        with self._transaction_lock:
+            for issuer in removed:
+                existing = self._issuers_by_id.get(issuer.id)
+                if existing is not None:
+                    self._unindex_issuer(existing)
+            for issuer in added_dict.values():
+                self._put_issuer(issuer)
+            self._issuers = list(self._issuers_by_id.values())
+            self._refresh_state()
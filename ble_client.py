@@ -1,26 +1,83 @@
 import asyncio
+import base64
 import logging
-import json
+import sys
 import time
-from typing import Optional, Callable, Dict, Any, List, Union
+from collections import OrderedDict
+from typing import Optional, Callable, Dict, Any, List, Set, Tuple
 import aiohttp
 from bleak import BleakClient, BleakScanner
+from bleak.assigned_numbers import AdvertisementDataType
 from bleak.backends.device import BLEDevice
 from bleak.backends.characteristic import BleakGATTCharacteristic
+from bleak.exc import BleakDBusError, BleakError
+
+from http_session import get_session
+from util import fastjson
 
 log = logging.getLogger(__name__)
 
 
+# Cleared once BlueZ turns out not to support advertisement monitors
+_hardware_filter_supported = sys.platform.startswith("linux")
+
+
+async def _start_lock_scanner(detection_callback: Optional[Callable], or_pattern: Optional[Tuple[int, bytes]] = None) -> BleakScanner:
+    """Start a scanner that lets the OS drop advertisements from other devices"""
+    global _hardware_filter_supported
+    if or_pattern is not None and _hardware_filter_supported:
+        # Passive scanning registers a BlueZ advertisement monitor, the controller matches the
+        # (start position, bytes) pattern in manufacturer data so other adverts never wake the host
+        start_position, content = or_pattern
+        scanner = None
+        try:
+            scanner = BleakScanner(
+                detection_callback=detection_callback,
+                scanning_mode="passive",
+                bluez={"or_patterns": [
+                    (start_position, AdvertisementDataType.MANUFACTURER_SPECIFIC_DATA, content)
+                ]}
+            )
+            await scanner.start()
+            return scanner
+        except Exception as e:
+            # Backends without passive scanning reject it when the scanner is built, BlueZ without
+            # advertisement monitors when it starts. Both raise a plain BleakError, whereas D-Bus
+            # errors such as a busy adapter are worth trying hardware filtering again for
+            if isinstance(e, BleakError) and not isinstance(e, BleakDBusError):
+                log.warning(f"Hardware advertisement filtering unavailable, falling back to service UUID filtering: {e}")
+                _hardware_filter_supported = False
+            else:
+                log.warning(f"Could not start hardware filtered scanning, falling back to service UUID filtering this time: {e}")
+            if scanner is not None:
+                try:
+                    await scanner.stop()
+                except Exception as e:
+                    log.debug(f"Error stopping BLE scanner that failed to start: {e}")
+            
+    scanner = BleakScanner(
+        detection_callback=detection_callback,
+        service_uuids=[BLELockClient.SESAME_SERVICE_UUID]
+    )
+    await scanner.start()
+    return scanner
+
+
 class DeviceInfo:
     """Information about a discovered BLE device"""
+    __slots__ = ("device", "serial", "last_seen")
+    
     def __init__(self, device: BLEDevice, serial: int, last_seen: float):
+        # last_seen is a time.monotonic() timestamp
         self.device = device
         self.serial = serial
         self.last_seen = last_seen
         
-    def is_stale(self, max_age_seconds: float = 300) -> bool:
+    def is_stale(self, max_age_seconds: float = 300, now: Optional[float] = None) -> bool:
         """Check if device info is stale (older than max_age_seconds)"""
-        return time.time() - self.last_seen > max_age_seconds
+        if now is None:
+            now = time.monotonic()
+        return now - self.last_seen > max_age_seconds
 
 
 class BLEDeviceRegistry:
@@ -29,55 +86,44 @@ class BLEDeviceRegistry:
     # Company ID for manufacturer data filtering
     COMPANY_ID = 0x065B
     
-    def __init__(self, scan_interval: float = 30.0, device_ttl: float = 300.0):
-        self.devices: Dict[int, DeviceInfo] = {}  # serial -> DeviceInfo
+    # Minimum seconds between refreshes of a device entry from repeated advertisements
+    REFRESH_INTERVAL = 1.0
+    # Background scanning pauses once no lock was registered for this many scan intervals,
+    # for IDLE_PAUSE_INTERVALS scan intervals at a time but no longer than MAX_IDLE_INTERVAL
+    IDLE_AFTER_INTERVALS = 5
+    IDLE_PAUSE_INTERVALS = 4
+    MAX_IDLE_INTERVAL = 300.0
+    
+    def __init__(self, scan_interval: float = 30.0, device_ttl: float = 300.0, hardware_filter: bool = False):
+        # serial -> DeviceInfo, ordered from least to most recently seen
+        self.devices: "OrderedDict[int, DeviceInfo]" = OrderedDict()
         self.scan_interval = scan_interval
         self.device_ttl = device_ttl
+        self.hardware_filter = hardware_filter
         self._scanning = False
         self._scan_task: Optional[asyncio.Task] = None
+        # The only scanner on the adapter, shared by background scanning and lookups and
+        # stopped once neither uses it
+        self._scanner: Optional[BleakScanner] = None
+        self._scanner_users = 0
+        self._scanner_lock: Optional[asyncio.Lock] = None
+        self._background_scanning = False  # Whether the scan loop is one of the scanner's users
+        self._last_hit = time.monotonic()  # When a lock was last registered
+        self._waiters: Dict[int, Set[asyncio.Event]] = {}  # serial -> events set once the device is seen
+        self._serial_by_address: Dict[str, int] = {}  # address -> serial of the devices entries
         
     @staticmethod
-    def _u64_to_lsb_uint8_array4(value: int) -> bytes:
-        """Convert 64-bit integer to 4-byte LSB array (matching TypeScript)"""
-        if value < 0 or value > 0xFFFFFFFFFFFFFFFF:
-            raise ValueError("Value must be an unsigned 64-bit integer")
-        
-        return value.to_bytes(4, byteorder='little')
-        
-    def _extract_serial_from_manufacturer_data(self, mfg_data: bytes) -> Optional[int]:
-        """Extract serial number from manufacturer data"""
-        if len(mfg_data) < 7:  # Need at least 3 + 4 bytes for serial
+    def _parse_lock_serial(mfg_data: bytes) -> Optional[int]:
+        """Serial number of the lock advertising this manufacturer data, None if it is not a lock"""
+        if len(mfg_data) < 7:  # Need at least 3 prefix + 4 serial bytes
             return None
             
-        # Serial is in bytes 3-6 (4 bytes, little endian)
+        # Serial is in bytes 3-6 (4 bytes, little endian). Any non-zero serial is accepted,
+        # which is more permissive than the original flag checking
         serial_bytes = mfg_data[3:7]
-        serial = int.from_bytes(serial_bytes, byteorder='little')
-        
-        # Debug logging for development
-        log.debug(f"Extracted serial {serial} from bytes {serial_bytes.hex().upper()}")
-        
-        return serial
-        
-    def _matches_lock_device(self, mfg_data: bytes) -> bool:
-        """Check if manufacturer data indicates this is a lock device"""
-        if len(mfg_data) < 7:  # Need at least 3 prefix + 4 serial bytes
-            return False
-            
-        # For now, let's be more permissive and just check if we can extract a serial
-        # The original TypeScript logic might have been more specific than needed
-        # We'll validate the pattern based on having a reasonable serial number structure
-        
-        # Check if bytes 3-6 look like a valid serial (not all zeros)
-        serial_bytes = mfg_data[3:7] if len(mfg_data) >= 7 else b'\x00\x00\x00\x00'
-        serial = int.from_bytes(serial_bytes, byteorder='little')
-        
-        # Accept devices that have a non-zero serial number
-        # This is more permissive than the original flag checking
-        is_valid = serial != 0
-        
-        log.debug(f"Lock device validation: serial={serial}, valid={is_valid}")
-        
-        return is_valid
+        if serial_bytes == b"\x00\x00\x00\x00":
+            return None
+        return int.from_bytes(serial_bytes, 'little')
         
     async def start_scanning(self):
         """Start continuous background scanning for devices"""
@@ -87,6 +133,7 @@ class BLEDeviceRegistry:
         log.info("🚀 Starting BLE device registry")
         
         self._scanning = True
+        self._last_hit = time.monotonic()
         self._scan_task = asyncio.create_task(self._scan_loop())
         
     async def stop_scanning(self):
@@ -94,62 +141,133 @@ class BLEDeviceRegistry:
         self._scanning = False
         if self._scan_task:
             self._scan_task.cancel()
-            try:
-                await self._scan_task
-            except asyncio.CancelledError:
-                pass
+            # Unlike awaiting the task, this doesn't swallow a cancellation of stop_scanning itself
+            await asyncio.wait({self._scan_task})
+            self._scan_task = None
+        if self._background_scanning:
+            self._background_scanning = False
+            await self._release_scanner()
         log.info("🛑 Stopped BLE device registry")
         
+    async def _start_scanner(self) -> BleakScanner:
+        """Start a scanner reporting to the registry"""
+        # With hardware filtering the controller matches our company ID
+        or_pattern = (0, self.COMPANY_ID.to_bytes(2, 'little')) if self.hardware_filter else None
+        return await _start_lock_scanner(self._detection_callback, or_pattern)
+        
+    async def _acquire_scanner(self):
+        """Start the shared scanner unless it is already running, and count one more user of it"""
+        if self._scanner_lock is None:
+            self._scanner_lock = asyncio.Lock()
+        async with self._scanner_lock:
+            if self._scanner is None:
+                self._scanner = await self._start_scanner()
+            self._scanner_users += 1
+            
+    async def _release_scanner(self):
+        """Count one user less of the shared scanner, stopping it once it is unused"""
+        # Shielded so the release completes even if the caller is cancelled, otherwise
+        # the scanner could be left running without any user
+        await asyncio.shield(self._release_scanner_now())
+        
+    async def _release_scanner_now(self):
+        async with self._scanner_lock:
+            self._scanner_users -= 1
+            if self._scanner_users == 0 and self._scanner is not None:
+                scanner, self._scanner = self._scanner, None
+                try:
+                    await scanner.stop()
+                except Exception as e:
+                    log.warning(f"Error stopping BLE scanner: {e}")
+        
     async def _scan_loop(self):
-        """Continuous scanning loop"""
+        """Keep the shared scanner running and periodically prune stale devices"""
         while self._scanning:
             try:
-                await self._perform_scan()
+                if not self._background_scanning:
+                    await self._acquire_scanner()
+                    self._background_scanning = True
                 await asyncio.sleep(self.scan_interval)
-            except asyncio.CancelledError:
-                break
+                self._cleanup_stale_devices()
+                if time.monotonic() - self._last_hit <= self.IDLE_AFTER_INTERVALS * self.scan_interval:
+                    continue
+                    
+                # No lock registered for a while, pause background scanning. Lookups keep the
+                # shared scanner running while they wait, so connecting isn't delayed
+                self._background_scanning = False
+                await self._release_scanner()
+                await asyncio.sleep(min(self.scan_interval * self.IDLE_PAUSE_INTERVALS, self.MAX_IDLE_INTERVAL))
             except Exception as e:
                 log.error(f"BLE scan error: {e}")
                 await asyncio.sleep(5)  # Short delay before retrying
                 
-    async def _perform_scan(self):
-        """Perform a single scan for devices"""
-        def detection_callback(device: BLEDevice, advertisement_data):
-            # Check if device has our company ID in manufacturer data
-            if self.COMPANY_ID in advertisement_data.manufacturer_data:
-                mfg_data = advertisement_data.manufacturer_data[self.COMPANY_ID]
-                
-                # Check if this looks like a lock device
-                if self._matches_lock_device(mfg_data):
-                    serial = self._extract_serial_from_manufacturer_data(mfg_data)
-                    
-                    if serial is not None:
-                        # Only log if this is a new device
-                        if serial not in self.devices:
-                            log.info(f"🔐 Discovered lock device: {device.name or 'Unknown'} (serial {serial})")
-                        
-                        current_time = time.time()
-                        self.devices[serial] = DeviceInfo(device, serial, current_time)
-        
-        # Scan for 5 seconds
-        async with BleakScanner(detection_callback=detection_callback) as scanner:
-            await asyncio.sleep(5.0)
+    def _detection_callback(self, device: BLEDevice, advertisement_data):
+        """Record lock devices seen in advertisements and wake up anyone waiting for them"""
+        # Check if device has our company ID in manufacturer data
+        mfg_data = advertisement_data.manufacturer_data.get(self.COMPANY_ID)
+        if mfg_data is None:
+            return
             
-        # Clean up stale devices
-        self._cleanup_stale_devices()
-        
+        current_time = time.monotonic()
+        serial = self._serial_by_address.get(device.address)
+        if serial is not None and current_time - self.devices[serial].last_seen < self.REFRESH_INTERVAL:
+            # Seen moments ago, nothing is waiting for it and it is nowhere near stale. Checked by
+            # address so the repeated advertisements aren't parsed either
+            return
+            
+        # Check if this looks like a lock device
+        serial = self._parse_lock_serial(mfg_data)
+        if serial is None:
+            return
+            
+        device_info = self.devices.get(serial)
+        if device_info is None:
+            # Only log if this is a new device
+            log.info(f"🔐 Discovered lock device: {device.name or 'Unknown'} (serial {serial})")
+            self.devices[serial] = DeviceInfo(device, serial, current_time)
+        else:
+            if current_time - device_info.last_seen < self.REFRESH_INTERVAL:
+                # Seen moments ago under another address
+                return
+            # Refresh the existing entry rather than allocating one per advertisement
+            self._forget_address(device_info)
+            device_info.device = device
+            device_info.last_seen = current_time
+            self.devices.move_to_end(serial)
+        self._serial_by_address[device.address] = serial
+        self._last_hit = current_time
+            
+        for waiter in self._waiters.get(serial, ()):
+            waiter.set()
+            
+    async def _scan(self, timeout: float, found: asyncio.Event):
+        """Keep the shared scanner running for up to timeout seconds, returning early once found is set"""
+        await self._acquire_scanner()
+        try:
+            await asyncio.wait_for(found.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await self._release_scanner()
+                
     def _cleanup_stale_devices(self):
         """Remove devices that haven't been seen recently"""
-        stale_serials = [
-            serial for serial, info in self.devices.items() 
-            if info.is_stale(self.device_ttl)
-        ]
-        
-        for serial in stale_serials:
-            device_info = self.devices[serial]
+        # Devices are ordered by last_seen, so stale ones are all at the front
+        now = time.monotonic()
+        while self.devices:
+            serial, device_info = next(iter(self.devices.items()))
+            if not device_info.is_stale(self.device_ttl, now):
+                break
             del self.devices[serial]
+            self._forget_address(device_info)
             log.info(f"🗑️ Pruned stale device: {device_info.device.name or 'Unknown'} (serial {serial})")
             
+    def _forget_address(self, device_info: DeviceInfo):
+        """Drop the address of a devices entry unless another lock advertises from it by now"""
+        address = device_info.device.address
+        if self._serial_by_address.get(address) == device_info.serial:
+            del self._serial_by_address[address]
+            
     def get_device(self, serial: int) -> Optional[BLEDevice]:
         """Get a cached device by serial number"""
         device_info = self.devices.get(serial)
@@ -159,14 +277,32 @@ class BLEDeviceRegistry:
         
     def list_available_devices(self) -> List[int]:
         """Get list of available device serial numbers"""
+        now = time.monotonic()
         return [
             serial for serial, info in self.devices.items()
-            if not info.is_stale(self.device_ttl)
+            if not info.is_stale(self.device_ttl, now)
         ]
         
     async def force_refresh(self, serial: int) -> Optional[BLEDevice]:
         """Force a refresh scan for a specific device"""
-        await self._perform_scan()
+        return await self.wait_for_device(serial)
+        
+    async def wait_for_device(self, serial: int, timeout: float = 15.0) -> Optional[BLEDevice]:
+        """Get a device by serial number, scanning until it advertises or timeout expires"""
+        device = self.get_device(serial)
+        if device:
+            return device
+            
+        waiter = asyncio.Event()
+        waiters = self._waiters.setdefault(serial, set())
+        waiters.add(waiter)
+        try:
+            # Reuses the scanner if background scanning or another lookup is running it already
+            await self._scan(timeout, found=waiter)
+        finally:
+            waiters.discard(waiter)
+            if not waiters:
+                self._waiters.pop(serial, None)
         return self.get_device(serial)
 
 
@@ -178,28 +314,57 @@ class BLELockClient:
     UART_TX_UUID = "6E400002-B5A3-F393-E0A9-E50E24DCCA9E"  # Write to this
     UART_RX_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"  # Notifications from this
     
-    def __init__(self, api_base_url: str = "http://localhost:8080", device_registry: Optional[BLEDeviceRegistry] = None, issuer_id: Optional[str] = None):
+    # Manufacturer data is [0x00,0x00,0x00] + 4 bytes serial (LSB) + 4 bytes + flags,
+    # a device matches when the serial is equal and the DFU/installable flags are clear.
+    # Both are checked with one masked compare of the first 12 bytes as a little endian int
+    DFU_FLAG = 0x08
+    INSTALLABLE_FLAG = 0x01
+    MANUFACTURER_DATA_MASK = int.from_bytes(
+        bytes([0x00, 0x00, 0x00, 0xff, 0xff, 0xff, 0xff, 0x00, 0x00, 0x00, 0x00, DFU_FLAG | INSTALLABLE_FLAG]),
+        'little'
+    )
+    
+    # Maximum number of received frames waiting to be posted to the REST API
+    RX_QUEUE_SIZE = 64
+    # Queued after the last frame to stop the worker once everything before it was posted
+    _RX_STOP = object()
+    # Time allowed for posting one frame, so a stalled API can't hold up the frames behind it
+    MESSAGE_TIMEOUT = aiohttp.ClientTimeout(total=2.0)
+    JSON_HEADERS = {'Content-Type': 'application/json'}
+    
+    def __init__(self, api_base_url: str = "http://localhost:8080", device_registry: Optional[BLEDeviceRegistry] = None, issuer_id: Optional[str] = None, session: Optional[aiohttp.ClientSession] = None, hardware_filter: bool = False):
         self.client: Optional[BleakClient] = None
         self.api_base_url = api_base_url
+        self._message_url = f"{api_base_url}/_r/homekey_ble_message_received"
         self.door_serial: Optional[int] = None
         self.disconnect_callback: Optional[Callable] = None
         self.device_registry = device_registry
         self.issuer_id = issuer_id
+        self._session = session
+        self.hardware_filter = hardware_filter
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._rx_queue: Optional[asyncio.Queue] = None
+        self._rx_worker: Optional[asyncio.Task] = None
+        self._tx_char: Optional[BleakGATTCharacteristic] = None
+        self._tx_without_response = False
+        
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Get the injected session, or the one shared on the running event loop"""
+        if self._session is not None:
+            return self._session
+        return await get_session()
         
     async def connect(self, serial: int, disconnect_callback: Optional[Callable] = None):
         """Connect to BLE device with given serial number"""
         self.door_serial = serial
         self.disconnect_callback = disconnect_callback
+        # Notification callbacks may arrive on a backend thread, received data is handed back to this loop
+        self._loop = asyncio.get_running_loop()
         
-        # Try to get device from registry first
-        target_device = None
+        # The registry returns a known device immediately, or scans until the device advertises
         if self.device_registry:
-            target_device = self.device_registry.get_device(serial)
-            if not target_device:
-                target_device = await self.device_registry.force_refresh(serial)
-        
-        # Fall back to manual scanning if not found in registry
-        if not target_device:
+            target_device = await self.device_registry.wait_for_device(serial, timeout=15.0)
+        else:
             target_device = await self._manual_scan_for_device(serial)
              
         if not target_device:
@@ -210,100 +375,158 @@ class BLELockClient:
         self.client = BleakClient(target_device, disconnected_callback=self._on_disconnect)
         await self.client.connect()
         
+        # Resolve the UART characteristics once instead of looking up their UUIDs on every write
+        self._tx_char = self.client.services.get_characteristic(self.UART_TX_UUID)
+        rx_char = self.client.services.get_characteristic(self.UART_RX_UUID)
+        if self._tx_char is None or rx_char is None:
+            await self.client.disconnect()
+            raise ConnectionError(f"BLE device {target_device.name} does not provide the UART service")
+        
+        # Received frames are handled in order by a single worker. The queue itself is unbounded
+        # so the stop marker always fits, RX_QUEUE_SIZE is enforced when frames are queued
+        self._rx_queue = asyncio.Queue()
+        self._rx_worker = asyncio.create_task(self._rx_loop(self._rx_queue))
+        
         # Start notifications for RX characteristic
-        await self.client.start_notify(self.UART_RX_UUID, self._on_data_received)
+        await self.client.start_notify(rx_char, self._on_data_received)
+        
+        # Write without response when the TX characteristic supports it, saving a round-trip per write
+        self._tx_without_response = "write-without-response" in self._tx_char.properties
+        log.debug(f"BLE TX accepts {self.max_write_size} bytes per write without response")
         
         log.info(f"Connected to BLE device {target_device.name}")
         
     async def _manual_scan_for_device(self, serial: int) -> Optional[BLEDevice]:
         """Manual scan for a specific device (fallback when registry doesn't have it)"""
         # Create manufacturer data filter (matching TypeScript logic)
-        dfu_flag = 0x08
-        installable_flag = 0x01
-        flag_mask = dfu_flag | installable_flag
-        
-        # Build data prefix: [0x00,0x00,0x00] + 4 bytes serial + [0x00,0x00,0x00,0x00,0x00]
-        serial_bytes = BLEDeviceRegistry._u64_to_lsb_uint8_array4(serial)
-        data_prefix = bytes([0x00, 0x00, 0x00]) + serial_bytes + bytes([0x00, 0x00, 0x00, 0x00, 0x00])
-        mask = bytes([0x00, 0x00, 0x00, 0xff, 0xff, 0xff, 0xff, 0x00, 0x00, 0x00, 0x00, flag_mask])
+        mask = self.MANUFACTURER_DATA_MASK
+        expected = (serial & 0xFFFFFFFF) << 24
         
         log.debug(f"Manual scanning for BLE device with serial {serial}")
         
         # Create filter function for manufacturer data matching
         def device_filter(device, advertisement_data):
             # Check if device has our company ID in manufacturer data
-            if BLEDeviceRegistry.COMPANY_ID in advertisement_data.manufacturer_data:
-                mfg_data = advertisement_data.manufacturer_data[BLEDeviceRegistry.COMPANY_ID]
+            mfg_data = advertisement_data.manufacturer_data.get(BLEDeviceRegistry.COMPANY_ID)
+            
+            # Check if manufacturer data matches our filter
+            if mfg_data is None or len(mfg_data) < 12:
+                return False
+            if (int.from_bytes(mfg_data[:12], 'little') & mask) != expected:
+                return False
                 
-                # Check if manufacturer data matches our filter
-                if len(mfg_data) >= len(data_prefix):
-                    # Apply mask to check if serial number matches
-                    for i in range(len(mask)):
-                        if i < len(mfg_data) and mask[i] != 0:
-                            if (mfg_data[i] & mask[i]) != (data_prefix[i] & mask[i]):
-                                return False
+            log.debug(f"Device {device.name} matches serial {serial}")
+            return True
+        
+        # With hardware filtering the controller matches the serial, which follows the
+        # 2 byte company ID and 3 leading bytes of the manufacturer data
+        or_pattern = (5, (serial & 0xFFFFFFFF).to_bytes(4, 'little')) if self.hardware_filter else None
+        scanner = await _start_lock_scanner(None, or_pattern)
+        
+        async def find_device() -> BLEDevice:
+            async for device, advertisement_data in scanner.advertisement_data():
+                if device_filter(device, advertisement_data):
+                    return device
                     
-                    log.debug(f"Device {device.name} matches serial {serial}")
-                    return True
-            return False
-        
-        # Use detection callback approach for scanning  
-        target_device = None
-        found_event = asyncio.Event()
-        
-        def detection_callback(device: BLEDevice, advertisement_data):
-            nonlocal target_device
-            if device_filter(device, advertisement_data):
-                target_device = device
-                found_event.set()
-        
-        scanner = BleakScanner(detection_callback=detection_callback)
-        await scanner.start()
-        
         try:
             # Wait up to 15 seconds for device to be found
-            await asyncio.wait_for(found_event.wait(), timeout=15.0)
+            return await asyncio.wait_for(find_device(), timeout=15.0)
         except asyncio.TimeoutError:
-            pass  # target_device will remain None
+            return None
         finally:
             await scanner.stop()
         
-        return target_device
-        
     async def disconnect(self):
-        """Disconnect from BLE device"""
+        """Disconnect from BLE device, after posting the frames already received"""
         if self.client and self.client.is_connected:
             await self.client.disconnect()
+        worker = self._stop_rx_worker()
+        # The worker itself disconnects when the API closes the connection, it exits once this call returns
+        if worker is not None and worker is not asyncio.current_task():
+            await worker
             
+    @property
+    def max_write_size(self) -> Optional[int]:
+        """Largest frame sent in a single write without response (ATT MTU - 3), None before connecting"""
+        if self._tx_char is None:
+            return None
+        return self._tx_char.max_write_without_response_size
+        
     async def write_tx(self, data: bytes):
         """Write data to TX characteristic"""
         if not self.client or not self.client.is_connected:
             raise ConnectionError("Not connected to BLE device")
             
-        await self.client.write_gatt_char(self.UART_TX_UUID, data)
-        log.info(f"🛜 Sent: 0x{data.hex().upper()}")
+        # Frames that don't fit a single unacknowledged write still go with a response
+        if self._tx_without_response and len(data) <= self.max_write_size:
+            await self.client.write_gatt_char(self._tx_char, data, response=False)
+        else:
+            await self.client.write_gatt_char(self._tx_char, data, response=True)
+        if log.isEnabledFor(logging.INFO):
+            log.info(f"🛜 Sent: 0x{data.hex().upper()}")
         
     def _on_disconnect(self, client: BleakClient):
         """Called when device disconnects"""
         log.info("BLE device disconnected")
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_rx_worker)
         if self.disconnect_callback:
             self.disconnect_callback()
             
     def _on_data_received(self, characteristic: BleakGATTCharacteristic, data: bytearray):
         """Called when data is received from device"""
-        log.info(f"🛜 Received: 0x{data.hex().upper()}")
+        if log.isEnabledFor(logging.INFO):
+            log.info(f"🛜 Received: 0x{data.hex().upper()}")
         
-        # Send data to REST API
-        asyncio.create_task(self._handle_received_data(list(data)))
+        # Send data to REST API, copying the frame since the buffer may be reused by the backend.
+        # Only callbacks from another thread need the (loop-waking) thread-safe hand-off
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._enqueue_received_data(bytes(data))
+        else:
+            self._loop.call_soon_threadsafe(self._enqueue_received_data, bytes(data))
         
-    async def _handle_received_data(self, message: list[int]):
+    def _enqueue_received_data(self, message: bytes):
+        """Queue a received frame for the worker, runs on the loop the client connected from"""
+        if self._rx_queue is None:
+            return
+        if self._rx_queue.qsize() >= self.RX_QUEUE_SIZE:
+            log.warning(f"Dropping received BLE frame, {self._rx_queue.qsize()} frames are pending")
+            return
+        self._rx_queue.put_nowait(message)
+            
+    async def _rx_loop(self, queue: asyncio.Queue):
+        """Post received frames to the REST API one at a time, preserving their order"""
+        while True:
+            message = await queue.get()
+            if message is self._RX_STOP:
+                return
+            await self._handle_received_data(message)
+            
+    def _stop_rx_worker(self) -> Optional[asyncio.Task]:
+        """Stop accepting received frames, the worker exits after posting those already queued"""
+        worker, self._rx_worker = self._rx_worker, None
+        if self._rx_queue is not None:
+            self._rx_queue.put_nowait(self._RX_STOP)
+            self._rx_queue = None
+        return worker
+        
+    async def _handle_received_data(self, message: bytes):
         """Handle received data by posting to REST API"""
         if not self.door_serial:
             log.error("No door serial set")
             return
             
-        payload: Dict[str, Union[list[int], str]] = {
-            "message": message
+        # Request format:
+        # {
+        #   "message": "<base64 encoded BLE frame>",
+        #   "issuerId": "<hex issuer id>"  (optional)
+        # }
+        payload: Dict[str, str] = {
+            "message": base64.b64encode(message).decode()
         }
         
         # Include issuer_id if available
@@ -311,17 +534,21 @@ class BLELockClient:
             payload["issuerId"] = self.issuer_id
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.api_base_url}/_r/homekey_ble_message_received",
-                    json=payload
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        await self._handle_api_response(data)
-                    else:
-                        log.error(f"API request failed with status {response.status}")
+            session = await self._get_session()
+            async with session.post(
+                self._message_url,
+                data=fastjson.dumps(payload),
+                headers=self.JSON_HEADERS,
+                timeout=self.MESSAGE_TIMEOUT
+            ) as response:
+                if response.status == 200:
+                    data = fastjson.loads(await response.read())
+                    await self._handle_api_response(data)
+                else:
+                    log.error(f"API request failed with status {response.status}")
                         
+        except asyncio.TimeoutError:
+            log.error(f"API request timed out after {self.MESSAGE_TIMEOUT.total}s, dropping BLE frame")
         except Exception as e:
             log.error(f"Error posting to API: {e}")
             
@@ -350,10 +577,12 @@ class BLELockClient:
 class BLELockManager:
     """Manager for multiple BLE lock connections with device registry"""
     
-    def __init__(self, api_base_url: str = "http://localhost:8080", enable_registry: bool = True):
+    def __init__(self, api_base_url: str = "http://localhost:8080", enable_registry: bool = True, session: Optional[aiohttp.ClientSession] = None, hardware_filter: bool = False):
         self.api_base_url = api_base_url
+        self.session = session
+        self.hardware_filter = hardware_filter
         self.connections: Dict[int, BLELockClient] = {}
-        self.device_registry = BLEDeviceRegistry() if enable_registry else None
+        self.device_registry = BLEDeviceRegistry(hardware_filter=hardware_filter) if enable_registry else None
         
     async def start(self):
         """Start the manager and begin device scanning"""
@@ -370,30 +599,37 @@ class BLELockManager:
         await self.disconnect_all()
         log.info("BLE Lock Manager stopped")
         
-    async def initiate_connection(self, serial: int, initial_message: list[int], issuer_id: Optional[str] = None):
+    async def initiate_connection(self, serial: int, initial_message: bytes, issuer_id: Optional[str] = None):
         """Initiate connection to lock and send initial message"""
-        if serial in self.connections:
+        client = self.connections.get(serial)
+        if client is not None:
             log.info(f"Already connected to device {serial}")
-            client = self.connections[serial]
         else:
-            client = BLELockClient(self.api_base_url, self.device_registry, issuer_id)
+            client = BLELockClient(self.api_base_url, self.device_registry, issuer_id, self.session, self.hardware_filter)
             
             def on_disconnect():
-                if serial in self.connections:
+                # Only forget this client, a newer connection may already have replaced it
+                if self.connections.get(serial) is client:
                     del self.connections[serial]
                     
             await client.connect(serial, on_disconnect)
             self.connections[serial] = client
             
         if initial_message:
-            await client.write_tx(bytes(initial_message))
+            await client.write_tx(initial_message)
             
         return client
         
     async def disconnect_all(self):
         """Disconnect all active connections"""
-        for client in list(self.connections.values()):
-            await client.disconnect()
+        # Disconnects are independent, run them concurrently so shutdown takes one round-trip
+        results = await asyncio.gather(
+            *(client.disconnect() for client in list(self.connections.values())),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                log.warning(f"Error disconnecting BLE client: {result}")
         self.connections.clear()
         
     async def get_connection(self, serial: int) -> Optional[BLELockClient]:
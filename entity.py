@@ -1,12 +1,15 @@
 import hashlib
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from enum import Enum, IntEnum
 from typing import List, Optional, Union
 
 from util.structable import represent
 from util.tlv import TLV8Field, TLV8Object
 
+# Hashed with a public key to derive issuer and reader group identifiers
+KEY_IDENTIFIER_PREFIX = b"key-identifier"
+
 
 class KeyType(IntEnum):
     CURVE25519 = 0x01
@@ -56,6 +59,9 @@ class Enrollments:
             else None,
         }
 
+    def clone(self):
+        return replace(self)
+
     def __repr__(self) -> str:
         return f"Enrollments({'hap' if self.hap else ''}, {'attestation' if self.attestation else ''})"
 
@@ -68,10 +74,22 @@ class Endpoint:
     public_key: bytes
     persistent_key: bytes
     enrollments: Enrollments
+    # (public_key, id, id hex) of the last id computation
+    _id_cache: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
+
+    def _identifiers(self):
+        if self._id_cache is None or self._id_cache[0] is not self.public_key:
+            id = hashlib.sha1(self.public_key).digest()[:6]
+            self._id_cache = (self.public_key, id, id.hex())
+        return self._id_cache
 
     @property
     def id(self):
-        return hashlib.sha1(self.public_key).digest()[:6]
+        return self._identifiers()[1]
+
+    @property
+    def id_hex(self):
+        return self._identifiers()[2]
 
     @classmethod
     def from_dict(cls, endpoint: dict):
@@ -94,6 +112,11 @@ class Endpoint:
             "enrollments": self.enrollments.to_dict(),
         }
 
+    def clone(self):
+        clone = replace(self, enrollments=self.enrollments.clone())
+        clone._id_cache = self._id_cache
+        return clone
+
     def __repr__(self) -> str:
         return f"Endpoint(last_used_at={self.last_used_at}, counter={self.counter}, key_type={represent(self.key_type)}, public_key={self.public_key.hex()}; persistent_key={self.persistent_key.hex()}, enrollments={self.enrollments})"
 
@@ -102,10 +125,23 @@ class Endpoint:
 class Issuer:
     public_key: bytes
     endpoints: List[Endpoint]
+    # (public_key, id, id hex) of the last id computation
+    _id_cache: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
+    _dict_cache: Optional[dict] = field(default=None, init=False, repr=False, compare=False)
+
+    def _identifiers(self):
+        if self._id_cache is None or self._id_cache[0] is not self.public_key:
+            id = hashlib.sha256(KEY_IDENTIFIER_PREFIX + self.public_key).digest()[:8]
+            self._id_cache = (self.public_key, id, id.hex())
+        return self._id_cache
 
     @property
     def id(self):
-        return hashlib.sha256("key-identifier".encode() + self.public_key).digest()[:8]
+        return self._identifiers()[1]
+
+    @property
+    def id_hex(self):
+        return self._identifiers()[2]
 
     @classmethod
     def from_dict(cls, issuer: dict):
@@ -121,10 +157,24 @@ class Issuer:
         return {
             "public_key": self.public_key.hex(),
             "endpoints": {
-                endpoint.id.hex(): endpoint.to_dict() for endpoint in self.endpoints
+                endpoint.id_hex: endpoint.to_dict() for endpoint in self.endpoints
             },
         }
 
+    def to_dict_cached(self):
+        """Same as to_dict, cached until invalidate_cache is called"""
+        if self._dict_cache is None:
+            self._dict_cache = self.to_dict()
+        return self._dict_cache
+
+    def invalidate_cache(self):
+        self._dict_cache = None
+
+    def clone(self):
+        clone = replace(self, endpoints=[endpoint.clone() for endpoint in self.endpoints])
+        clone._id_cache = self._id_cache
+        return clone
+
     def __repr__(self) -> str:
         return f"Issuer(public_key={self.public_key.hex()}, endpoints={self.endpoints})"
 
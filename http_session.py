@@ -0,0 +1,33 @@
+import asyncio
+import logging
+from typing import Dict
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+# aiohttp sessions are bound to the event loop they were created on, so one is kept per loop
+_sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Get the pooled session shared by all API clients on the running event loop"""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=10),
+            connector=aiohttp.TCPConnector(
+                limit=100, limit_per_host=32, keepalive_timeout=75
+            ),
+        )
+        _sessions[loop] = session
+    return session
+
+
+async def close_session():
+    """Close the session shared on the running event loop"""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+        log.debug("Closed shared HTTP session")
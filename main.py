@@ -1,7 +1,7 @@
-import json
 import logging
 import signal
 import sys
+from pathlib import Path
 
 from pyhap.accessory_driver import AccessoryDriver
 
@@ -9,6 +9,7 @@ from accessory import Lock
 from repository import Repository
 from api_repository import APIRepository
 from service import Service
+from util import fastjson
 from util.bfclf import BroadcastFrameContactlessFrontend
 
 # By default, this file is located in the same folder as the project
@@ -16,7 +17,7 @@ CONFIGURATION_FILE_PATH = "configuration.json"
 
 
 def load_configuration(path=CONFIGURATION_FILE_PATH) -> dict:
-    return json.load(open(path, "r+"))
+    return fastjson.loads(Path(path).read_bytes())
 
 
 def configure_logging(config: dict):
@@ -72,6 +73,7 @@ def configure_homekey_service(config: dict, nfc_device, repository=None):
         throttle_polling=float(config.get("throttle_polling") or 0.15),
         api_base_url=config.get("api_base_url", "http://localhost:8080"),
         default_lock_serial=config.get("default_lock_serial", 0),
+        ble_hardware_filter=config.get("ble_hardware_filter", False),
     )
     return service
 
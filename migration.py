@@ -11,13 +11,13 @@ from pathlib import Path
 
 from repository import Repository
 from api_repository import APIRepository
+from util import fastjson
 
 
 def load_configuration(path="configuration.json") -> dict:
     """Load configuration from JSON file"""
     try:
-        with open(path, "r") as f:
-            return json.load(f)
+        return fastjson.loads(Path(path).read_bytes())
     except FileNotFoundError:
         print(f"Configuration file {path} not found")
         sys.exit(1)
@@ -56,6 +56,7 @@ def migrate_data(config: dict, log):
     
     log.info(f"Starting migration from {file_path} to {api_base_url}")
     
+    api_repo = None
     try:
         # Create file-based repository
         log.info("Loading data from file-based repository...")
@@ -89,6 +90,9 @@ def migrate_data(config: dict, log):
             for issuer in all_issuers:
                 log.info(f"Migrated issuer {issuer.id.hex()[:16]}... with {len(issuer.endpoints)} endpoints")
         
+        # Changes are saved in the background, make sure they reach the API before verifying
+        api_repo.flush()
+        
         log.info("Migration completed successfully!")
         
         # Verify migration by checking API repository
@@ -97,7 +101,11 @@ def migrate_data(config: dict, log):
         api_reader_key = api_repo.get_reader_private_key()
         api_reader_id = api_repo.get_reader_identifier()
         
-        if (len(api_issuers) == len(all_issuers) and 
+        # Compare issuer and endpoint ids rather than only counts, without diffing full issuer data
+        expected_ids = {(i.id, frozenset(e.id for e in i.endpoints)) for i in all_issuers}
+        api_ids = {(i.id, frozenset(e.id for e in i.endpoints)) for i in api_issuers}
+        
+        if (api_ids == expected_ids and 
             api_reader_key == reader_private_key and 
             api_reader_id == reader_identifier):
             log.info("✓ Migration verification successful!")
@@ -110,6 +118,9 @@ def migrate_data(config: dict, log):
     except Exception as e:
         log.exception(f"Migration failed: {e}")
         return False
+    finally:
+        if api_repo is not None:
+            api_repo.close()
 
 
 def main():
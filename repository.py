@@ -5,7 +5,7 @@ import logging
 from threading import Lock
 from typing import List, Optional
 
-from entity import Endpoint, Issuer
+from entity import KEY_IDENTIFIER_PREFIX, Endpoint, Issuer
 
 log = logging.getLogger()
 
@@ -20,6 +20,7 @@ class Repository:
         self._reader_private_key = bytes.fromhex("00" * 32)
         self._reader_identifier = bytes.fromhex("00" * 8)
         self._issuers = list()
+        self._reader_group_identifier: Optional[bytes] = None
         self._transaction_lock = Lock()
         self._state_lock = Lock()
         self._load_state_from_file()
@@ -31,6 +32,7 @@ class Repository:
                 self._reader_private_key = bytes.fromhex(
                     configuration.get("reader_private_key", "00" * 32)
                 )
+                self._reader_group_identifier = None
                 self._reader_identifier = bytes.fromhex(
                     configuration.get("reader_identifier", "00" * 8)
                 )
@@ -62,12 +64,17 @@ class Repository:
         self._save_state_to_file()
         self._load_state_from_file()
 
+    def close(self):
+        """Release any resources held by the repository"""
+        pass
+
     def get_reader_private_key(self):
         return self._reader_private_key
 
     def set_reader_private_key(self, reader_private_key):
         with self._transaction_lock:
             self._reader_private_key = reader_private_key
+            self._reader_group_identifier = None
             self._refresh_state()
 
     def get_reader_identifier(self):
@@ -79,9 +86,12 @@ class Repository:
             self._refresh_state()
 
     def get_reader_group_identifier(self):
-        return (
-            hashlib.sha256("key-identifier".encode() + self.get_reader_private_key())
-        ).digest()[:8]
+        # Derived from the private key, polled on every NFC cycle so only hashed when the key changes
+        if self._reader_group_identifier is None:
+            self._reader_group_identifier = (
+                hashlib.sha256(KEY_IDENTIFIER_PREFIX + self.get_reader_private_key())
+            ).digest()[:8]
+        return self._reader_group_identifier
 
     def get_all_issuers(self):
         return copy.deepcopy([i for i in self._issuers])
@@ -123,10 +133,12 @@ class Repository:
         )
 
     def get_issuer_by_endpoint(self, endpoint: Endpoint) -> Optional[Issuer]:
-        return next(
-            (issuer for issuer in self.get_all_issuers() 
+        # Called on every authenticated tap, so only the matching issuer is copied
+        issuer = next(
+            (issuer for issuer in self._issuers
              if any(ep.id == endpoint.id for ep in issuer.endpoints)), None
         )
+        return copy.deepcopy(issuer) if issuer is not None else None
 
     def remove_issuer(self, issuer: Issuer):
         with self._transaction_lock:
@@ -162,11 +174,20 @@ class Repository:
             self._refresh_state()
 
     def upsert_issuers(self, issuers: List[Issuer]):
-        issuers_dict = {issuer.id: copy.deepcopy(issuer) for issuer in issuers}
+        issuers_dict = {issuer.id: issuer.clone() for issuer in issuers}
+        with self._transaction_lock:
+            # Keyed by id so merging is linear; existing issuers keep their position
+            iss = {i.id: i for i in self._issuers}
+            iss.update(issuers_dict)
+            self._issuers = list(iss.values())
+            self._refresh_state()
+
+    def apply_issuer_changes(self, added: List[Issuer], removed: List[Issuer]):
+        """Upsert and remove issuers in a single transaction, saving state once"""
+        added_dict = {issuer.id: issuer.clone() for issuer in added}
+        removed_ids = {issuer.id for issuer in removed}
         with self._transaction_lock:
-            iss = [issuers_dict.get(i.id, i) for i in copy.deepcopy(self._issuers)]
-            for issuer in issuers_dict.values():
-                if issuer not in iss:
-                    iss.append(issuer)
-            self._issuers = iss
+            iss = {i.id: i for i in self._issuers if i.id not in removed_ids}
+            iss.update(added_dict)
+            self._issuers = list(iss.values())
             self._refresh_state()
@@ -4,7 +4,7 @@ import logging
 import time
 import os
 from operator import attrgetter
-from threading import Thread
+from threading import Event, Thread
 
 from entity import (
     Issuer,
@@ -38,9 +38,12 @@ from util.threads import create_runner
 from util.structable import pack_into_base64_string, unpack_from_base64_string
 from ble_client import BLELockManager
 from api_client import LockAPIClient
+from http_session import close_session
 
 log = logging.getLogger()
 
+PREFERRED_VERSIONS = (b"\x02\x00",)
+
 
 class Service:
     def __init__(
@@ -52,7 +55,8 @@ class Service:
         flow: str = "fast",
         throttle_polling = 0.1,
         api_base_url: str = "http://localhost:8080",
-        default_lock_serial: int = None  # Deprecated - serial now comes from API
+        default_lock_serial: int = None,  # Deprecated - serial now comes from API
+        ble_hardware_filter: bool = False
     ) -> None:
         self.repository = repository
         self.clf = clf
@@ -62,11 +66,12 @@ class Service:
 
         # Initialize BLE and API clients
         self.api_client = LockAPIClient(api_base_url)
-        self.ble_manager = BLELockManager(api_base_url)
+        self.ble_manager = BLELockManager(api_base_url, hardware_filter=ble_hardware_filter)
         
         # Event loop for async operations
         self._event_loop = None
         self._event_loop_thread = None
+        self._event_loop_ready = Event()
 
         try:
             self.hardware_finish_color = HardwareFinishColor[finish.upper()]
@@ -83,6 +88,32 @@ class Service:
                 f"Digital Key flow {flow} is not supported. Falling back to {self.flow}"
             )
 
+        # Packed ECP frame broadcast on every poll, rebuilt only when the reader group identifier changes
+        self._ecp_frame = None
+        self._ecp_frame_identifier = None
+
+        # Static HAP responses, controllers read these repeatedly
+        self._hardware_finish_response = pack_into_base64_string(
+            HardwareFinishResponse(color=self.hardware_finish_color)
+        )
+        self._supported_configuration_response = pack_into_base64_string(
+            SupportedConfigurationResponse(
+                number_of_issuer_keys=16, number_of_inactive_credentials=16
+            )
+        )
+
+        # Control point operation handlers, looked up by the request operation
+        self._device_credential_handlers = {
+            Operation.GET: self.get_device_credential,
+            Operation.ADD: self.add_device_credential,
+            Operation.REMOVE: self.remove_device_credential,
+        }
+        self._reader_key_handlers = {
+            Operation.GET: self.get_reader_key,
+            Operation.ADD: self.add_reader_key,
+            Operation.REMOVE: self.remove_reader_key,
+        }
+
         self._run_flag = True
         self._runner = None
 
@@ -132,10 +163,10 @@ class Service:
                 self._event_loop
             )
             
-            # Don't block the NFC thread, but log the result
+            # Don't block the NFC thread, but log the result once the activation finishes
             def log_result(future):
                 try:
-                    result = future.result(timeout=1)
+                    result = future.result()
                     if result:
                         log.info("Lock activation completed successfully")
                     else:
@@ -143,14 +174,15 @@ class Service:
                 except Exception as e:
                     log.error(f"Lock activation error: {e}")
                     
-            future.add_done_callback(lambda f: log_result(f))
+            future.add_done_callback(log_result)
         else:
             log.error("Event loop not available for BLE activation")
 
     def _start_event_loop(self):
         """Start the event loop in a separate thread for async operations"""
+        # Not installed as the thread's current loop, work only reaches it via run_coroutine_threadsafe
         self._event_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self._event_loop)
+        self._event_loop.call_soon(self._event_loop_ready.set)
         self._event_loop.run_forever()
 
     def start(self):
@@ -158,9 +190,9 @@ class Service:
         self._event_loop_thread = Thread(target=self._start_event_loop, daemon=True)
         self._event_loop_thread.start()
         
-        # Wait for event loop to be ready
-        while self._event_loop is None:
-            time.sleep(0.01)
+        # Wait for event loop to be running
+        if not self._event_loop_ready.wait(timeout=5):
+            raise RuntimeError("Event loop thread failed to start")
             
         # Start BLE device registry for faster connections
         async def start_ble_registry():
@@ -186,50 +218,62 @@ class Service:
         if self._runner is not None:
             self._runner.join()
             
-        # Clean up async resources
+        # Clean up async resources, the loop stops itself once cleanup is done or timed out
         if self._event_loop is not None:
-            async def cleanup_ble():
+            async def shutdown():
                 try:
-                    await self.ble_manager.stop()
+                    await asyncio.wait_for(self.ble_manager.stop(), timeout=8)
                     log.info("BLE device registry stopped")
                 except Exception as e:
-                    log.error(f"Error stopping BLE device registry: {e}")
-            
-            asyncio.run_coroutine_threadsafe(
-                cleanup_ble(),
-                self._event_loop
-            ).result(timeout=10)
-            self._event_loop.call_soon_threadsafe(self._event_loop.stop)
-            
+                    log.error(f"Error stopping BLE device registry: {e!r}")
+                try:
+                    await close_session()
+                finally:
+                    self._event_loop.stop()
+
+            asyncio.run_coroutine_threadsafe(shutdown(), self._event_loop)
+
         if self._event_loop_thread is not None:
-            self._event_loop_thread.join(timeout=5)
+            self._event_loop_thread.join(timeout=10)
+
+        self.repository.close()
 
     def update_hap_pairings(self, issuer_public_keys):
+        issuer_public_keys = frozenset(issuer_public_keys)
         issuers = {
             issuer.public_key: issuer for issuer in self.repository.get_all_issuers()
         }
-        for issuer in issuers.values():
-            if issuer.public_key in issuer_public_keys:
-                continue
+        removed = []
+        for issuer_public_key in issuers.keys() - issuer_public_keys:
+            issuer = issuers[issuer_public_key]
             log.info(f"Removing issuer {issuer} as their pairing has been removed")
-            self.repository.remove_issuer(issuer)
+            removed.append(issuer)
 
-        for issuer_public_key in issuer_public_keys:
-            if issuer_public_key in issuers:
-                continue
+        added = []
+        for issuer_public_key in issuer_public_keys - issuers.keys():
             issuer = Issuer(public_key=issuer_public_key, endpoints=[])
             log.info(f"Adding issuer {issuer} based on paired clients")
-            self.repository.upsert_issuer(issuer)
+            added.append(issuer)
+
+        if added or removed:
+            self.repository.apply_issuer_changes(added, removed)
+
+    def _get_ecp_frame(self, reader_group_identifier: bytes) -> bytes:
+        if self._ecp_frame is None or self._ecp_frame_identifier != reader_group_identifier:
+            self._ecp_frame = ECP.home(
+                identifier=reader_group_identifier,
+                flag_2=self.express,
+            ).pack()
+            self._ecp_frame_identifier = reader_group_identifier
+        return self._ecp_frame
 
     def _read_homekey(self):
         start = time.monotonic()
+        reader_group_identifier = self.repository.get_reader_group_identifier()
 
         remote_target = self.clf.sense(
             RemoteTarget("106A"),
-            broadcast=ECP.home(
-                identifier=self.repository.get_reader_group_identifier(),
-                flag_2=self.express,
-            ).pack(),
+            broadcast=self._get_ecp_frame(reader_group_identifier),
         )
 
         if remote_target is None:
@@ -245,9 +289,11 @@ class Service:
             log.info(
                 f"Found non-ISODEP Tag with UID: {target.identifier.hex().upper()}"
             )
+            delay = 0.1
             while self.clf.sense(RemoteTarget("106A")) is not None:
                 log.info("Waiting for target to leave the field...")
-                time.sleep(0.5)
+                time.sleep(delay)
+                delay = min(delay * 1.5, 1.5)
             return
 
         log.info(f"Got NFC tag {target}")
@@ -257,10 +303,10 @@ class Service:
             result_flow, new_issuers_state, endpoint = read_homekey(
                 tag,
                 issuers=self.repository.get_all_issuers(),
-                preferred_versions=[b"\x02\x00"],
+                preferred_versions=PREFERRED_VERSIONS,
                 flow=self.flow,
                 transaction_code=DigitalKeyTransactionType.UNLOCK,
-                reader_identifier=self.repository.get_reader_group_identifier()
+                reader_identifier=reader_group_identifier
                 + self.repository.get_reader_identifier(),
                 reader_private_key=self.repository.get_reader_private_key(),
                 key_size=16,
@@ -271,8 +317,8 @@ class Service:
 
             log.info(f"Authenticated endpoint via {result_flow!r}: {endpoint}")
 
-            end = time.monotonic()
-            log.info(f"Transaction took {(end - start) * 1000} ms")
+            if log.isEnabledFor(logging.INFO):
+                log.info(f"Transaction took {(time.monotonic() - start) * 1000} ms")
 
             if endpoint is not None:
                 self.on_endpoint_authenticated(endpoint)
@@ -280,9 +326,12 @@ class Service:
             log.info(f'Could not authenticate device due to protocol error "{e}"')
 
         # Let device cool down, wait for ISODEP to drop to consider comms finished
+        # Presence checks back off the longer the device lingers to spare RF roundtrips
+        delay = 0.1
         while target.is_present:
             log.info("Waiting for device to leave the field...")
-            time.sleep(0.5)
+            time.sleep(delay)
+            delay = min(delay * 1.5, 1.5)
         log.info("Device left the field. Continuing in 2 seconds...")
         time.sleep(2)
         log.info("Waiting for next device...")
@@ -397,18 +446,12 @@ class Service:
         log.info(f"*** remove_device_credential request={request}")
 
     def get_hardware_finish(self):
-        result = pack_into_base64_string(
-            HardwareFinishResponse(color=self.hardware_finish_color)
-        )
+        result = self._hardware_finish_response
         log.info(f"get_hardware_finish={result}")
         return result
 
     def get_nfc_access_supported_configuration(self):
-        result = pack_into_base64_string(
-            SupportedConfigurationResponse(
-                number_of_issuer_keys=16, number_of_inactive_credentials=16
-            )
-        )
+        result = self._supported_configuration_response
         log.info(f"TODO get_nfc_access_supported_configuration={result}")
         return result
 
@@ -419,37 +462,29 @@ class Service:
     def set_nfc_access_control_point(self, value):
         log.info(f"<-- (B64) {value}")
         request_packed_tlv = unpack_from_base64_string(value)
-        log.info(f"<-- (TLV) {request_packed_tlv.hex()}")
+        if log.isEnabledFor(logging.INFO):
+            log.info(f"<-- (TLV) {request_packed_tlv.hex()}")
         request: ControlPointRequest = ControlPointRequest.unpack(request_packed_tlv)
         log.info(f"<-- (OBJ) {request}")
         operation = request.operation
         response = ControlPointResponse()
 
         if request.device_credential_request is not None:
-            subrequest: DeviceCredentialRequest = request.device_credential_request
+            handler = self._device_credential_handlers.get(operation)
             response.device_credential_response = (
-                self.get_device_credential(subrequest)
-                if operation == Operation.GET
-                else self.add_device_credential(subrequest)
-                if operation == Operation.ADD
-                else self.remove_device_credential(subrequest)
-                if operation == Operation.REMOVE
+                handler(request.device_credential_request)
+                if handler is not None
                 else None
             )
         elif request.reader_key_request is not None:
-            subrequest: ReaderKeyRequest = request.reader_key_request
+            handler = self._reader_key_handlers.get(operation)
             response.reader_key_response = (
-                self.get_reader_key(subrequest)
-                if operation == Operation.GET
-                else self.add_reader_key(subrequest)
-                if operation == Operation.ADD
-                else self.remove_reader_key(subrequest)
-                if operation == Operation.REMOVE
-                else None
+                handler(request.reader_key_request) if handler is not None else None
             )
         log.info(f"--> (OBJ) {response}")
         packed_tlv_response = response.pack()
-        log.info(f"--> (TLV) {packed_tlv_response.hex()}")
+        if log.isEnabledFor(logging.INFO):
+            log.info(f"--> (TLV) {packed_tlv_response.hex()}")
         response = pack_into_base64_string(packed_tlv_response)
         log.info(f"--> (B64) {response}")
         return response
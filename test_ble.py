@@ -41,16 +41,26 @@ async def test_ble_scan():
         from bleak import BleakScanner
         
         log.info("Scanning for BLE devices...")
-        devices = await BleakScanner.discover(timeout=5.0)
+        devices = {}
         
-        log.info(f"Found {len(devices)} BLE devices:")
-        for device in devices:
-            log.info(f"  - {device.name or 'Unknown'} ({device.address})")
-            
-        # Look for Nordic UART devices
-        nordic_devices = [d for d in devices if d.name and "nordic" in d.name.lower()]
-        if nordic_devices:
-            log.info(f"Found {len(nordic_devices)} potential Nordic UART devices")
+        async with BleakScanner() as scanner:
+            # Stream advertisements so the scan ends as soon as a Nordic UART device shows up
+            async def find_nordic_device():
+                async for device, _ in scanner.advertisement_data():
+                    if device.address not in devices:
+                        devices[device.address] = device
+                        log.info(f"  - {device.name or 'Unknown'} ({device.address})")
+                    if device.name and "nordic" in device.name.lower():
+                        return device
+                        
+            try:
+                nordic_device = await asyncio.wait_for(find_nordic_device(), timeout=5.0)
+            except asyncio.TimeoutError:
+                nordic_device = None
+        
+        log.info(f"Found {len(devices)} BLE devices")
+        if nordic_device is not None:
+            log.info(f"Found Nordic UART device {nordic_device.name} ({nordic_device.address})")
         else:
             log.info("No Nordic UART devices found")
             
@@ -66,7 +76,7 @@ async def test_ble_manager():
     
     # This will fail unless you have a real BLE device, but tests the code path
     try:
-        await ble_manager.initiate_connection(12345, [0x01, 0x02, 0x03], "test_issuer_123")
+        await ble_manager.initiate_connection(12345, bytes([0x01, 0x02, 0x03]), "test_issuer_123")
         log.info("BLE connection test passed")
     except Exception as e:
         log.info(f"BLE connection test failed (expected): {e}")
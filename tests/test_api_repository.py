@@ -0,0 +1,256 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import api_repository
+from api_repository import APIRepository
+from entity import Endpoint, Enrollments, Issuer, KeyType
+from util import fastjson
+
+
+class FakeAPI:
+    """Stands in for the HTTP layer of APIRepository, keeping state like the server would"""
+
+    def __init__(self, state=None):
+        self.state = state or {}
+        self.reads = 0
+        self.saves = []
+
+    async def load(self):
+        self.reads += 1
+        return fastjson.dumps(self.state)
+
+    async def save(self, body):
+        self.saves.append(fastjson.loads(body))
+        self.state = self.saves[-1]
+        return True
+
+
+def make_endpoint(counter=0):
+    return Endpoint(
+        last_used_at=0,
+        counter=counter,
+        key_type=KeyType.SECP256R1,
+        public_key=b"\x04" + os.urandom(64),
+        persistent_key=os.urandom(32),
+        enrollments=Enrollments(hap=None, attestation=None),
+    )
+
+
+def make_issuer(*endpoints):
+    return Issuer(public_key=os.urandom(32), endpoints=list(endpoints))
+
+
+class TestAPIRepository:
+    @pytest.fixture()
+    def api(self, monkeypatch):
+        api = FakeAPI(
+            {
+                "reader_private_key": "11" * 32,
+                "reader_identifier": "22" * 8,
+                "issuers": {},
+            }
+        )
+        monkeypatch.setattr(APIRepository, "_async_load_state", api.load)
+        monkeypatch.setattr(APIRepository, "_async_save_state", api.save)
+        return api
+
+    @pytest.fixture()
+    def repository(self, api):
+        repository = APIRepository("http://localhost:8080")
+        yield repository
+        repository.close()
+
+    def test_loads_state_on_init(self, api, repository):
+        assert repository.get_reader_private_key() == bytes.fromhex("11" * 32)
+        assert repository.get_reader_identifier() == bytes.fromhex("22" * 8)
+        assert api.reads == 1
+
+    def test_close_without_changes_does_not_save(self, api, repository):
+        # Another client edits the state after it was loaded
+        api.state = dict(api.state, reader_identifier="33" * 8)
+        repository.close()
+        assert api.saves == []
+        assert api.state["reader_identifier"] == "33" * 8
+
+    def test_close_saves_pending_changes(self, api, repository):
+        repository.set_reader_identifier(bytes.fromhex("44" * 8))
+        repository.close()
+        assert len(api.saves) == 1
+        assert api.saves[0]["reader_identifier"] == "44" * 8
+
+    def test_upsert_issuer_indexes_issuer_and_endpoints(self, repository):
+        endpoint = make_endpoint()
+        issuer = make_issuer(endpoint)
+        repository.upsert_issuer(issuer)
+        assert repository.get_issuer_by_id(issuer.id) == issuer
+        assert repository.get_issuer_by_public_key(issuer.public_key) == issuer
+        assert repository.get_endpoint_by_id(endpoint.id) == endpoint
+        assert repository.get_endpoint_by_public_key(endpoint.public_key) == endpoint
+        assert repository.get_issuer_by_endpoint(endpoint).id == issuer.id
+
+    def test_upsert_issuer_replaces_endpoints_of_existing_issuer(self, repository):
+        old_endpoint, new_endpoint = make_endpoint(), make_endpoint()
+        issuer = make_issuer(old_endpoint)
+        repository.upsert_issuer(issuer)
+        repository.upsert_issuer(Issuer(public_key=issuer.public_key, endpoints=[new_endpoint]))
+        assert len(repository.get_all_issuers()) == 1
+        assert repository.get_endpoint_by_id(old_endpoint.id) is None
+        assert repository.get_endpoint_by_public_key(old_endpoint.public_key) is None
+        assert repository.get_issuer_by_endpoint(old_endpoint) is None
+        assert repository.get_issuer_by_endpoint(new_endpoint).id == issuer.id
+
+    def test_upsert_endpoint_indexes_and_replaces_endpoint(self, repository):
+        issuer = make_issuer()
+        repository.upsert_issuer(issuer)
+        endpoint = make_endpoint()
+        repository.upsert_endpoint(issuer.id, endpoint)
+        assert repository.get_issuer_by_endpoint(endpoint).id == issuer.id
+        endpoint.counter = 5
+        repository.upsert_endpoint(issuer.id, endpoint)
+        assert repository.get_endpoint_by_id(endpoint.id).counter == 5
+        assert len(repository.get_all_endpoints()) == 1
+
+    def test_upsert_endpoint_ignores_unknown_issuer(self, repository):
+        endpoint = make_endpoint()
+        repository.upsert_endpoint(os.urandom(8), endpoint)
+        assert repository.get_endpoint_by_id(endpoint.id) is None
+
+    def test_remove_issuer_unindexes_issuer_and_endpoints(self, repository):
+        endpoint = make_endpoint()
+        issuer = make_issuer(endpoint)
+        other = make_issuer()
+        repository.upsert_issuers([issuer, other])
+        repository.remove_issuer(issuer)
+        assert [i.id for i in repository.get_all_issuers()] == [other.id]
+        assert repository.get_issuer_by_id(issuer.id) is None
+        assert repository.get_issuer_by_public_key(issuer.public_key) is None
+        assert repository.get_endpoint_by_id(endpoint.id) is None
+        assert repository.get_issuer_by_endpoint(endpoint) is None
+
+    def test_apply_issuer_changes(self, repository):
+        kept, removed, added = make_issuer(), make_issuer(make_endpoint()), make_issuer()
+        repository.upsert_issuers([kept, removed])
+        repository.apply_issuer_changes([added], [removed])
+        assert {i.id for i in repository.get_all_issuers()} == {kept.id, added.id}
+        assert repository.get_issuer_by_public_key(removed.public_key) is None
+
+    def test_returned_entities_are_isolated(self, repository):
+        issuer = make_issuer(make_endpoint())
+        repository.upsert_issuer(issuer)
+        # Neither the upserted object nor returned copies share state with the repository
+        issuer.endpoints.append(make_endpoint())
+        copy = repository.get_issuer_by_id(issuer.id)
+        copy.endpoints[0].counter = 7
+        copy.endpoints.append(make_endpoint())
+        stored = repository.get_issuer_by_id(issuer.id)
+        assert len(stored.endpoints) == 1
+        assert stored.endpoints[0].counter == 0
+
+    def test_mutations_are_coalesced_into_one_save(self, api, repository, monkeypatch):
+        monkeypatch.setattr(repository, "SAVE_DELAY", 0.2)
+        issuer = make_issuer()
+        repository.upsert_issuer(issuer)
+        endpoint = make_endpoint()
+        repository.upsert_endpoint(issuer.id, endpoint)
+        repository.set_reader_identifier(bytes.fromhex("55" * 8))
+        time.sleep(0.6)
+        assert len(api.saves) == 1
+        saved = api.saves[0]
+        assert saved["reader_identifier"] == "55" * 8
+        assert list(saved["issuers"][issuer.id.hex()]["endpoints"]) == [endpoint.id.hex()]
+
+    def test_saved_state_reflects_updated_endpoint(self, api, repository):
+        issuer = make_issuer()
+        endpoint = make_endpoint()
+        repository.upsert_issuer(issuer)
+        repository.upsert_endpoint(issuer.id, endpoint)
+        repository.flush()
+        endpoint.counter = 3
+        repository.upsert_endpoint(issuer.id, endpoint)
+        repository.flush()
+        saved_endpoint = api.saves[-1]["issuers"][issuer.id.hex()]["endpoints"][endpoint.id.hex()]
+        assert saved_endpoint["counter"] == 3
+
+    def test_unchanged_state_is_not_saved_again(self, api, repository):
+        repository.set_reader_identifier(bytes.fromhex("66" * 8))
+        repository.flush()
+        repository.set_reader_identifier(bytes.fromhex("66" * 8))
+        repository.flush()
+        assert len(api.saves) == 1
+
+    def test_reload_picks_up_remote_changes(self, api, repository):
+        issuer = make_issuer(make_endpoint())
+        api.state = dict(
+            api.state,
+            reader_identifier="77" * 8,
+            issuers={issuer.id.hex(): issuer.to_dict()},
+        )
+        assert repository._load_state_from_api()
+        assert repository.get_reader_identifier() == bytes.fromhex("77" * 8)
+        assert repository.get_issuer_by_id(issuer.id) == issuer
+        assert repository.get_issuer_by_endpoint(issuer.endpoints[0]).id == issuer.id
+        # The same body again is recognised by its digest and not applied twice
+        assert not repository._load_state_from_api()
+
+    def test_save_after_reload_is_not_skipped(self, api, repository):
+        repository.set_reader_identifier(bytes.fromhex("44" * 8))
+        repository.flush()
+        # Another client changes the state, which is picked up by a reload
+        api.state = dict(api.state, reader_identifier="55" * 8)
+        assert repository._load_state_from_api()
+        # Restoring the previously saved state still has to reach the API
+        repository.set_reader_identifier(bytes.fromhex("44" * 8))
+        repository.flush()
+        assert len(api.saves) == 2
+        assert api.state["reader_identifier"] == "44" * 8
+
+    def test_reload_does_not_replace_unsaved_changes(self, api, repository, monkeypatch):
+        # Keep the change unsaved until the explicit flush
+        monkeypatch.setattr(repository, "SAVE_DELAY", 10)
+        api.state = dict(api.state, reader_identifier="88" * 8)
+        repository.set_reader_identifier(bytes.fromhex("99" * 8))
+        assert not repository._load_state_from_api()
+        assert repository.get_reader_identifier() == bytes.fromhex("99" * 8)
+        repository.flush()
+        assert api.state["reader_identifier"] == "99" * 8
+
+    def test_reload_discards_response_overlapping_a_save(self, api, repository, monkeypatch):
+        load = api.load
+
+        async def load_while_saving():
+            body = await load()
+            # A mutation is saved while the response is on its way
+            await asyncio.to_thread(repository.set_reader_identifier, bytes.fromhex("99" * 8))
+            return body
+
+        monkeypatch.setattr(repository, "_async_load_state", load_while_saving)
+        api.state = dict(api.state, reader_identifier="88" * 8)
+        assert not repository._load_state_from_api()
+        assert repository.get_reader_identifier() == bytes.fromhex("99" * 8)
+        repository.flush()
+        assert api.state["reader_identifier"] == "99" * 8
+
+    def test_periodic_reads_back_off_only_while_unchanged(self, repository, monkeypatch):
+        # Unchanged, unchanged, skipped, failed, changed, unchanged
+        results = iter([False, False, None, RuntimeError("API unavailable"), True, False])
+        intervals = []
+
+        async def reload_state():
+            result = next(results)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        async def sleep(interval):
+            intervals.append(interval)
+            if len(intervals) > 6:
+                raise asyncio.CancelledError()
+
+        monkeypatch.setattr(repository, "_async_reload_state", reload_state)
+        monkeypatch.setattr(api_repository.asyncio, "sleep", sleep)
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(repository._periodic_read())
+        assert intervals == [60, 120, 240, 240, 240, 60, 120]
@@ -0,0 +1,446 @@
+import asyncio
+
+import pytest
+from bleak.exc import BleakDBusError, BleakError
+
+import ble_client
+from ble_client import BLELockClient, _start_lock_scanner
+
+
+class FakeDevice:
+    def __init__(self, name="Lock", address="AA:BB:CC:DD:EE:FF"):
+        self.name = name
+        self.address = address
+
+
+class FakeCharacteristic:
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.properties = ["write", "write-without-response", "notify"]
+        self.max_write_without_response_size = 244
+
+
+class FakeBleakClient:
+    """Stands in for BleakClient, the test delivers notifications through notify()"""
+
+    def __init__(self, device, disconnected_callback=None):
+        self.device = device
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self.services = self
+        self.characteristics = {
+            uuid: FakeCharacteristic(uuid)
+            for uuid in (BLELockClient.UART_TX_UUID, BLELockClient.UART_RX_UUID)
+        }
+        self.notify_callback = None
+        self.writes = []
+
+    def get_characteristic(self, uuid):
+        return self.characteristics.get(uuid)
+
+    async def connect(self):
+        self.is_connected = True
+
+    async def disconnect(self):
+        if self.is_connected:
+            self.is_connected = False
+            self.disconnected_callback(self)
+
+    async def start_notify(self, characteristic, callback):
+        self.notify_callback = callback
+
+    async def write_gatt_char(self, characteristic, data, response=False):
+        self.writes.append((characteristic.uuid, bytes(data), response))
+
+    def notify(self, data: bytes):
+        self.notify_callback(
+            self.characteristics[BLELockClient.UART_RX_UUID], bytearray(data)
+        )
+
+
+class FakeAdvertisementData:
+    def __init__(self, manufacturer_data):
+        self.manufacturer_data = manufacturer_data
+
+
+class FakeBleakScanner:
+    """Stands in for BleakScanner, the test feeds advertisements through advertise()"""
+
+    reject_passive = False
+    # Raised when starting a passive scanner
+    passive_start_error = None
+
+    def __init__(self, detection_callback=None, **kwargs):
+        if kwargs.get("scanning_mode") == "passive" and self.reject_passive:
+            raise BleakError("passive scanning not supported")
+        self.detection_callback = detection_callback
+        self.kwargs = kwargs
+        self.running = False
+        self.stopped = False
+        self.instances.append(self)
+
+    async def start(self):
+        if self.kwargs.get("scanning_mode") == "passive" and self.passive_start_error:
+            raise self.passive_start_error
+        self.running = True
+
+    async def stop(self):
+        self.running = False
+        self.stopped = True
+
+    def advertise(self, device, manufacturer_data):
+        if self.running and self.detection_callback is not None:
+            self.detection_callback(
+                device, FakeAdvertisementData(manufacturer_data)
+            )
+
+
+class FakeRegistry:
+    async def wait_for_device(self, serial, timeout=15.0):
+        return FakeDevice()
+
+
+class FakeAPI:
+    def __init__(self):
+        self.posted = []
+        self.responses = {}
+
+
+class TestBLELockClient:
+    @pytest.fixture()
+    def api(self, monkeypatch):
+        """Replaces posting frames to the API, with a short in-flight delay per request"""
+        api = FakeAPI()
+
+        async def handle_received_data(client, message):
+            await asyncio.sleep(0.01)
+            api.posted.append(message)
+            if message in api.responses:
+                await client._handle_api_response(api.responses[message])
+
+        monkeypatch.setattr(ble_client, "BleakClient", FakeBleakClient)
+        monkeypatch.setattr(
+            BLELockClient, "_handle_received_data", handle_received_data
+        )
+        return api
+
+    @staticmethod
+    async def connect():
+        client = BLELockClient(device_registry=FakeRegistry())
+        await client.connect(1234)
+        return client
+
+    def test_frames_queued_before_lock_disconnects_are_posted(self, api):
+        async def run():
+            client = await self.connect()
+            worker = client._rx_worker
+            for frame in (b"\x01", b"\x02", b"\x03"):
+                client.client.notify(frame)
+            # The lock drops the connection right after its last frame
+            await client.client.disconnect()
+            await asyncio.wait_for(worker, timeout=1)
+            assert worker.exception() is None
+
+        asyncio.run(run())
+        assert api.posted == [b"\x01", b"\x02", b"\x03"]
+
+    def test_close_requested_by_api_lets_worker_drain_and_exit(self, api):
+        api.responses[b"\x01"] = {"tag": "close_bluetooth_connection"}
+
+        async def run():
+            client = await self.connect()
+            worker = client._rx_worker
+            client.client.notify(b"\x01")
+            client.client.notify(b"\x02")
+            await asyncio.wait_for(worker, timeout=1)
+            assert not worker.cancelled()
+            assert worker.exception() is None
+            assert not client.client.is_connected
+            assert client._rx_queue is None
+
+        asyncio.run(run())
+        assert api.posted == [b"\x01", b"\x02"]
+
+    def test_disconnect_waits_for_pending_frames(self, api):
+        async def run():
+            client = await self.connect()
+            client.client.notify(b"\x01")
+            client.client.notify(b"\x02")
+            await client.disconnect()
+            # Frames arriving after disconnect are dropped
+            client._on_data_received(None, bytearray(b"\x03"))
+            await asyncio.sleep(0.05)
+
+        asyncio.run(run())
+        assert api.posted == [b"\x01", b"\x02"]
+
+    def test_frames_up_to_max_write_size_are_written_without_response(self, api):
+        async def run():
+            client = BLELockClient(device_registry=FakeRegistry())
+            assert client.max_write_size is None
+            await client.connect(1234)
+            assert client.max_write_size == 244
+            await client.write_tx(bytes(244))
+            await client.write_tx(bytes(245))
+            return client.client.writes
+
+        writes = asyncio.run(run())
+        assert [response for _, _, response in writes] == [False, True]
+
+    def test_frames_over_queue_size_are_dropped(self, api, monkeypatch):
+        monkeypatch.setattr(BLELockClient, "RX_QUEUE_SIZE", 2)
+
+        async def run():
+            client = await self.connect()
+            for frame in (b"\x01", b"\x02", b"\x03"):
+                client.client.notify(frame)
+            await client.disconnect()
+
+        asyncio.run(run())
+        assert api.posted == [b"\x01", b"\x02"]
+
+
+class TestStartLockScanner:
+    @pytest.fixture()
+    def scanner_class(self, monkeypatch):
+        scanner_class = type("Scanner", (FakeBleakScanner,), {"instances": []})
+        monkeypatch.setattr(ble_client, "BleakScanner", scanner_class)
+        monkeypatch.setattr(ble_client, "_hardware_filter_supported", True)
+        return scanner_class
+
+    def test_starts_passive_scanner_with_pattern(self, scanner_class):
+        scanner = asyncio.run(_start_lock_scanner(None, (0, b"\x5b\x06")))
+        assert scanner.running
+        assert scanner.kwargs["scanning_mode"] == "passive"
+        assert ble_client._hardware_filter_supported
+
+    def test_falls_back_when_passive_scanner_cannot_be_created(self, scanner_class):
+        scanner_class.reject_passive = True
+        scanner = asyncio.run(_start_lock_scanner(None, (0, b"\x5b\x06")))
+        assert scanner.running
+        assert scanner.kwargs["service_uuids"] == [BLELockClient.SESAME_SERVICE_UUID]
+        assert not ble_client._hardware_filter_supported
+
+    def test_falls_back_for_good_when_passive_scanning_is_unsupported(self, scanner_class):
+        scanner_class.passive_start_error = BleakError("passive scanning on Linux requires BlueZ >= 5.55")
+        scanner = asyncio.run(_start_lock_scanner(None, (0, b"\x5b\x06")))
+        assert scanner.kwargs["service_uuids"] == [BLELockClient.SESAME_SERVICE_UUID]
+        assert scanner_class.instances[0].stopped
+        assert not ble_client._hardware_filter_supported
+
+    def test_retries_passive_scanning_after_dbus_errors(self, scanner_class):
+        scanner_class.passive_start_error = BleakDBusError("org.bluez.Error.InProgress", [])
+        scanner = asyncio.run(_start_lock_scanner(None, (0, b"\x5b\x06")))
+        assert scanner.running
+        assert scanner.kwargs["service_uuids"] == [BLELockClient.SESAME_SERVICE_UUID]
+        assert scanner_class.instances[0].stopped
+        assert ble_client._hardware_filter_supported
+        scanner_class.passive_start_error = None
+        scanner = asyncio.run(_start_lock_scanner(None, (0, b"\x5b\x06")))
+        assert scanner.kwargs["scanning_mode"] == "passive"
+
+
+def lock_advertisement(serial):
+    return {
+        ble_client.BLEDeviceRegistry.COMPANY_ID: bytes(3) + serial.to_bytes(4, "little") + bytes(5)
+    }
+
+
+class TestBLEDeviceRegistry:
+    @pytest.fixture()
+    def scanner_class(self, monkeypatch):
+        scanner_class = type("Scanner", (FakeBleakScanner,), {"instances": []})
+        monkeypatch.setattr(ble_client, "BleakScanner", scanner_class)
+        return scanner_class
+
+    @staticmethod
+    def running(scanner_class):
+        return [scanner for scanner in scanner_class.instances if scanner.running]
+
+    def test_background_scanning_pauses_once_no_lock_was_seen(self, scanner_class, monkeypatch):
+        monkeypatch.setattr(ble_client.BLEDeviceRegistry, "IDLE_AFTER_INTERVALS", 2.5)
+
+        async def run():
+            registry = ble_client.BLEDeviceRegistry(scan_interval=0.05)
+            await registry.start_scanning()
+            await asyncio.sleep(0.07)
+            assert len(self.running(scanner_class)) == 1
+            # Paused after the third interval without a lock, for four intervals
+            await asyncio.sleep(0.18)
+            assert self.running(scanner_class) == []
+            scan_task = registry._scan_task
+            await registry.stop_scanning()
+            assert scan_task.cancelled()
+            assert registry._scanner_users == 0
+
+        asyncio.run(run())
+
+    def test_advertising_lock_keeps_background_scanning_on(self, scanner_class, monkeypatch):
+        monkeypatch.setattr(ble_client.BLEDeviceRegistry, "IDLE_AFTER_INTERVALS", 2.5)
+        monkeypatch.setattr(ble_client.BLEDeviceRegistry, "REFRESH_INTERVAL", 0)
+
+        async def run():
+            registry = ble_client.BLEDeviceRegistry(scan_interval=0.05)
+            await registry.start_scanning()
+            await asyncio.sleep(0)
+            scanner, = self.running(scanner_class)
+            for _ in range(10):
+                scanner.advertise(FakeDevice(), lock_advertisement(1234))
+                await asyncio.sleep(0.04)
+                assert scanner.running
+            await registry.stop_scanning()
+            assert not scanner.running
+
+        asyncio.run(run())
+        assert len(scanner_class.instances) == 1
+
+    def test_background_scanning_resumes_on_running_lookup_scanner(self, scanner_class, monkeypatch):
+        monkeypatch.setattr(ble_client.BLEDeviceRegistry, "IDLE_AFTER_INTERVALS", 2.5)
+
+        async def run():
+            registry = ble_client.BLEDeviceRegistry(scan_interval=0.1)
+            await registry.start_scanning()
+            # Without locks nearby background scanning pauses from 0.3 to 0.7 s
+            await asyncio.sleep(0.5)
+            assert self.running(scanner_class) == []
+            lookup = asyncio.create_task(registry.wait_for_device(1234, timeout=1))
+            # Background scanning resumes while the lookup is still waiting
+            await asyncio.sleep(0.25)
+            assert registry._background_scanning
+            assert len(self.running(scanner_class)) == 1
+            device = FakeDevice()
+            self.running(scanner_class)[0].advertise(device, lock_advertisement(1234))
+            assert await lookup is device
+            # The lookup is done, background scanning keeps the scanner running
+            assert len(self.running(scanner_class)) == 1
+            await registry.stop_scanning()
+            assert self.running(scanner_class) == []
+            assert registry._scanner_users == 0
+
+        asyncio.run(run())
+        assert len(scanner_class.instances) == 2
+
+    def test_cancelled_release_still_stops_scanner(self, scanner_class):
+        async def run():
+            registry = ble_client.BLEDeviceRegistry()
+            await registry._acquire_scanner()
+            scanner = registry._scanner
+            # The release is cancelled while waiting for the lock
+            await registry._scanner_lock.acquire()
+            release = asyncio.create_task(registry._release_scanner())
+            await asyncio.sleep(0)
+            release.cancel()
+            await asyncio.sleep(0)
+            registry._scanner_lock.release()
+            await asyncio.sleep(0.01)
+            assert release.cancelled()
+            assert registry._scanner_users == 0
+            assert registry._scanner is None
+            assert not scanner.running
+
+        asyncio.run(run())
+
+    def test_lookup_reuses_background_scanner(self, scanner_class):
+        async def run():
+            registry = ble_client.BLEDeviceRegistry(scan_interval=1)
+            await registry.start_scanning()
+            await asyncio.sleep(0)
+            assert await registry.wait_for_device(1234, timeout=0.05) is None
+            assert len(self.running(scanner_class)) == 1
+            await registry.stop_scanning()
+
+        asyncio.run(run())
+        assert len(scanner_class.instances) == 1
+
+    def test_repeated_advertisements_are_not_parsed(self, monkeypatch):
+        parsed = []
+        parse = ble_client.BLEDeviceRegistry._parse_lock_serial
+
+        def parse_lock_serial(mfg_data):
+            parsed.append(mfg_data)
+            return parse(mfg_data)
+
+        monkeypatch.setattr(ble_client.BLEDeviceRegistry, "_parse_lock_serial", staticmethod(parse_lock_serial))
+        registry = ble_client.BLEDeviceRegistry()
+        device = FakeDevice()
+        advertisement = FakeAdvertisementData(lock_advertisement(1234))
+        for _ in range(3):
+            registry._detection_callback(device, advertisement)
+        assert len(parsed) == 1
+        # Once the entry is due for a refresh the advertisement is parsed again
+        registry.devices[1234].last_seen -= registry.REFRESH_INTERVAL
+        moved = FakeDevice(address="11:22:33:44:55:66")
+        registry._detection_callback(moved, advertisement)
+        assert len(parsed) == 2
+        assert registry.get_device(1234) is moved
+        assert registry._serial_by_address == {moved.address: 1234}
+        registry.devices[1234].last_seen -= registry.device_ttl + 1
+        registry._cleanup_stale_devices()
+        assert registry._serial_by_address == {}
+
+    def test_serial_is_parsed_from_manufacturer_data(self):
+        parse = ble_client.BLEDeviceRegistry._parse_lock_serial
+        assert parse(bytes(3) + (0x12345678).to_bytes(4, "little")) == 0x12345678
+        # The DFU/installable flags don't matter to the registry
+        assert parse(lock_advertisement(1234)[ble_client.BLEDeviceRegistry.COMPANY_ID][:11] + b"\x09") == 1234
+        assert parse(bytes(12)) is None
+        assert parse(bytes(6)) is None
+
+    def test_cached_device_is_returned_without_scanning(self, scanner_class):
+        registry = ble_client.BLEDeviceRegistry()
+        device = FakeDevice()
+        registry._detection_callback(device, FakeAdvertisementData(lock_advertisement(1234)))
+        assert asyncio.run(registry.wait_for_device(1234)) is device
+        assert scanner_class.instances == []
+
+    def test_lookup_is_woken_by_advertisement(self, scanner_class):
+        async def run():
+            registry = ble_client.BLEDeviceRegistry()
+            lookup = asyncio.create_task(registry.wait_for_device(1234, timeout=1))
+            await asyncio.sleep(0)
+            scanner, = self.running(scanner_class)
+            # Other locks don't wake the lookup
+            scanner.advertise(FakeDevice(address="11:22:33:44:55:66"), lock_advertisement(5678))
+            await asyncio.sleep(0)
+            assert not lookup.done()
+            device = FakeDevice()
+            scanner.advertise(device, lock_advertisement(1234))
+            assert await asyncio.wait_for(lookup, timeout=0.1) is device
+            assert registry._waiters == {}
+            assert not scanner.running
+
+        asyncio.run(run())
+
+    def test_lookup_timeout_cleans_up(self, scanner_class):
+        async def run():
+            registry = ble_client.BLEDeviceRegistry()
+            assert await registry.wait_for_device(1234, timeout=0.05) is None
+            assert registry._waiters == {}
+            assert registry._scanner is None
+            assert registry._scanner_users == 0
+
+        asyncio.run(run())
+        scanner, = scanner_class.instances
+        assert not scanner.running
+
+    def test_concurrent_lookups_share_one_scanner(self, scanner_class):
+        async def run():
+            registry = ble_client.BLEDeviceRegistry()
+            first = asyncio.create_task(registry.wait_for_device(1234, timeout=1))
+            second = asyncio.create_task(registry.wait_for_device(1234, timeout=1))
+            other = asyncio.create_task(registry.wait_for_device(5678, timeout=0.05))
+            await asyncio.sleep(0.01)
+            assert registry._scanner_users == 3
+            assert len(registry._waiters[1234]) == 2
+            assert await other is None
+            scanner, = self.running(scanner_class)
+            device = FakeDevice()
+            scanner.advertise(device, lock_advertisement(1234))
+            assert await first is device
+            assert await second is device
+            assert registry._scanner_users == 0
+            assert registry._waiters == {}
+            assert not scanner.running
+
+        asyncio.run(run())
+        assert len(scanner_class.instances) == 1
@@ -0,0 +1,72 @@
+import hashlib
+import os
+
+from entity import Endpoint, Enrollment, Enrollments, Issuer, KeyType
+
+
+def make_endpoint(counter=0):
+    return Endpoint(
+        last_used_at=0,
+        counter=counter,
+        key_type=KeyType.SECP256R1,
+        public_key=b"\x04" + os.urandom(64),
+        persistent_key=os.urandom(32),
+        enrollments=Enrollments(hap=Enrollment(at=1, payload="hap"), attestation=None),
+    )
+
+
+class TestClone:
+    def test_endpoint_clone_is_equal_and_independent(self):
+        endpoint = make_endpoint()
+        clone = endpoint.clone()
+        assert clone == endpoint
+        clone.counter = 1
+        clone.enrollments.attestation = Enrollment(at=2, payload="attestation")
+        assert endpoint.counter == 0
+        assert endpoint.enrollments.attestation is None
+
+    def test_issuer_clone_is_equal_and_independent(self):
+        issuer = Issuer(public_key=os.urandom(32), endpoints=[make_endpoint()])
+        clone = issuer.clone()
+        assert clone == issuer
+        clone.endpoints[0].counter = 1
+        clone.endpoints.append(make_endpoint())
+        assert len(issuer.endpoints) == 1
+        assert issuer.endpoints[0].counter == 0
+
+
+class TestCaches:
+    def test_ids_follow_public_key(self):
+        issuer = Issuer(public_key=os.urandom(32), endpoints=[])
+        endpoint = make_endpoint()
+        assert issuer.id == hashlib.sha256(b"key-identifier" + issuer.public_key).digest()[:8]
+        assert endpoint.id == hashlib.sha1(endpoint.public_key).digest()[:6]
+        issuer.public_key = os.urandom(32)
+        endpoint.public_key = b"\x04" + os.urandom(64)
+        assert issuer.id == hashlib.sha256(b"key-identifier" + issuer.public_key).digest()[:8]
+        assert issuer.id_hex == issuer.id.hex()
+        assert endpoint.id == hashlib.sha1(endpoint.public_key).digest()[:6]
+        assert endpoint.id_hex == endpoint.id.hex()
+
+    def test_cached_dict_is_kept_until_invalidated(self):
+        endpoint = make_endpoint()
+        issuer = Issuer(public_key=os.urandom(32), endpoints=[endpoint])
+        cached = issuer.to_dict_cached()
+        assert cached == issuer.to_dict()
+        endpoint.counter = 3
+        assert issuer.to_dict_cached() is cached
+        issuer.invalidate_cache()
+        assert issuer.to_dict_cached()["endpoints"][endpoint.id_hex]["counter"] == 3
+
+    def test_clone_does_not_share_cached_dict(self):
+        issuer = Issuer(public_key=os.urandom(32), endpoints=[make_endpoint()])
+        cached = issuer.to_dict_cached()
+        clone = issuer.clone()
+        clone.endpoints = []
+        assert clone.to_dict_cached() is not cached
+        assert clone.to_dict_cached()["endpoints"] == {}
+        assert clone.id == issuer.id
+
+    def test_round_trip(self):
+        issuer = Issuer(public_key=os.urandom(32), endpoints=[make_endpoint(5)])
+        assert Issuer.from_dict(issuer.to_dict()) == issuer
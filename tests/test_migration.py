@@ -0,0 +1,66 @@
+import logging
+import os
+
+import pytest
+
+from api_repository import APIRepository
+from entity import Endpoint, Enrollments, Issuer, KeyType
+from migration import migrate_data
+from repository import Repository
+from tests.test_api_repository import FakeAPI
+
+log = logging.getLogger()
+
+
+def make_issuer():
+    endpoint = Endpoint(
+        last_used_at=0,
+        counter=0,
+        key_type=KeyType.SECP256R1,
+        public_key=b"\x04" + os.urandom(64),
+        persistent_key=os.urandom(32),
+        enrollments=Enrollments(hap=None, attestation=None),
+    )
+    return Issuer(public_key=os.urandom(32), endpoints=[endpoint])
+
+
+class TestMigration:
+    @pytest.fixture()
+    def api(self, monkeypatch):
+        api = FakeAPI()
+        monkeypatch.setattr(APIRepository, "_async_load_state", api.load)
+        monkeypatch.setattr(APIRepository, "_async_save_state", api.save)
+        return api
+
+    @pytest.fixture()
+    def path(self, tmp_path):
+        return str(tmp_path / "homekey.json")
+
+    @pytest.fixture()
+    def config(self, path):
+        return {"homekey": {"persist": path, "api_base_url": "http://localhost:8080"}}
+
+    def test_migrates_and_verifies_file_state(self, api, path, config):
+        repository = Repository(path)
+        repository.set_reader_private_key(os.urandom(32))
+        repository.set_reader_identifier(os.urandom(8))
+        issuers = [make_issuer(), make_issuer()]
+        repository.upsert_issuers(issuers)
+        assert migrate_data(config, log)
+        assert len(api.saves) == 1
+        assert api.state["reader_private_key"] == repository.get_reader_private_key().hex()
+        assert api.state["reader_identifier"] == repository.get_reader_identifier().hex()
+        assert set(api.state["issuers"]) == {issuer.id.hex() for issuer in issuers}
+
+    def test_verification_fails_when_api_holds_other_issuers(self, api, path, config):
+        other = make_issuer()
+        api.state = {"issuers": {other.id.hex(): other.to_dict()}}
+        Repository(path).upsert_issuer(make_issuer())
+        assert not migrate_data(config, log)
+
+    def test_missing_file_has_nothing_to_migrate(self, api, config):
+        assert migrate_data(config, log)
+        assert api.saves == []
+
+    def test_api_base_url_is_required(self, api, path):
+        assert not migrate_data({"homekey": {"persist": path}}, log)
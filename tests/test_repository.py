@@ -0,0 +1,77 @@
+import hashlib
+import os
+
+import pytest
+
+from entity import Endpoint, Enrollments, Issuer, KeyType
+from repository import Repository
+
+
+def make_endpoint(counter=0):
+    return Endpoint(
+        last_used_at=0,
+        counter=counter,
+        key_type=KeyType.SECP256R1,
+        public_key=b"\x04" + os.urandom(64),
+        persistent_key=os.urandom(32),
+        enrollments=Enrollments(hap=None, attestation=None),
+    )
+
+
+def make_issuer(*endpoints):
+    return Issuer(public_key=os.urandom(32), endpoints=list(endpoints))
+
+
+class TestRepository:
+    @pytest.fixture()
+    def path(self, tmp_path):
+        return str(tmp_path / "homekey.json")
+
+    @pytest.fixture()
+    def repository(self, path):
+        return Repository(path)
+
+    def test_state_is_saved_to_file(self, path, repository):
+        issuer = make_issuer(make_endpoint())
+        repository.set_reader_private_key(os.urandom(32))
+        repository.upsert_issuer(issuer)
+        reloaded = Repository(path)
+        assert reloaded.get_reader_private_key() == repository.get_reader_private_key()
+        assert reloaded.get_all_issuers() == [issuer]
+
+    def test_upsert_issuers_merges_by_id(self, repository):
+        first, second = make_issuer(), make_issuer()
+        repository.upsert_issuers([first, second])
+        updated = Issuer(public_key=first.public_key, endpoints=[make_endpoint()])
+        added = make_issuer()
+        repository.upsert_issuers([added, updated])
+        # Existing issuers keep their position, new ones are appended
+        assert repository.get_all_issuers() == [updated, second, added]
+
+    def test_get_issuer_by_endpoint(self, repository):
+        endpoint = make_endpoint()
+        issuer = make_issuer(endpoint)
+        repository.upsert_issuers([make_issuer(make_endpoint()), issuer])
+        found = repository.get_issuer_by_endpoint(endpoint)
+        assert found == issuer
+        # A copy is returned, changing it doesn't change the repository
+        found.endpoints.clear()
+        assert repository.get_issuer_by_endpoint(endpoint) == issuer
+        assert repository.get_issuer_by_endpoint(make_endpoint()) is None
+
+    def test_apply_issuer_changes(self, path, repository):
+        kept, removed, added = make_issuer(), make_issuer(make_endpoint()), make_issuer()
+        repository.upsert_issuers([kept, removed])
+        repository.apply_issuer_changes([added], [removed])
+        assert repository.get_all_issuers() == [kept, added]
+        assert Repository(path).get_all_issuers() == [kept, added]
+
+    def test_reader_group_identifier_follows_private_key(self, repository):
+        private_key = os.urandom(32)
+        repository.set_reader_private_key(private_key)
+        expected = hashlib.sha256(b"key-identifier" + private_key).digest()[:8]
+        assert repository.get_reader_group_identifier() == expected
+        private_key = os.urandom(32)
+        repository.set_reader_private_key(private_key)
+        expected = hashlib.sha256(b"key-identifier" + private_key).digest()[:8]
+        assert repository.get_reader_group_identifier() == expected
@@ -0,0 +1,188 @@
+import os
+import time
+
+import pytest
+
+from entity import (
+    ControlPointRequest,
+    ControlPointResponse,
+    DeviceCredentialRequest,
+    Endpoint,
+    Enrollments,
+    HardwareFinishColor,
+    HardwareFinishResponse,
+    Issuer,
+    KeyState,
+    KeyType,
+    Operation,
+    OperationStatus,
+    ReaderKeyRequest,
+    SupportedConfigurationResponse,
+)
+from repository import Repository
+from service import Service
+from util.structable import pack_into_base64_string, unpack_from_base64_string
+
+
+class FakeFrontend:
+    """Stands in for the NFC frontend, no device is ever in the field"""
+
+    path = "fake"
+
+    def __init__(self):
+        self.device = None
+
+    def open(self, path):
+        self.device = object()
+
+    def sense(self, *args, **kwargs):
+        return None
+
+
+class RecordingRepository(Repository):
+    def __init__(self, storage_file_path):
+        super().__init__(storage_file_path)
+        self.closed = False
+        self.changes = []
+
+    def close(self):
+        self.closed = True
+
+    def apply_issuer_changes(self, added, removed):
+        self.changes.append((added, removed))
+        super().apply_issuer_changes(added, removed)
+
+
+def make_endpoint():
+    return Endpoint(
+        last_used_at=0,
+        counter=0,
+        key_type=KeyType.SECP256R1,
+        public_key=b"\x04" + os.urandom(64),
+        persistent_key=os.urandom(32),
+        enrollments=Enrollments(hap=None, attestation=None),
+    )
+
+
+def control_point(service, request):
+    response = service.set_nfc_access_control_point(pack_into_base64_string(request.pack()))
+    return ControlPointResponse.unpack(unpack_from_base64_string(response))
+
+
+class TestService:
+    @pytest.fixture()
+    def repository(self, tmp_path):
+        return RecordingRepository(str(tmp_path / "homekey.json"))
+
+    @pytest.fixture()
+    def service(self, repository):
+        return Service(FakeFrontend(), repository, throttle_polling=0.01)
+
+    @pytest.fixture()
+    def ble_calls(self, service):
+        calls = []
+
+        async def start():
+            calls.append("start")
+
+        async def stop():
+            calls.append("stop")
+
+        service.ble_manager.start = start
+        service.ble_manager.stop = stop
+        return calls
+
+    def test_stop_cleans_up_ble_and_closes_repository(self, service, ble_calls):
+        service.start()
+        time.sleep(0.05)
+        service.stop()
+        assert ble_calls == ["start", "stop"]
+        assert not service._runner.is_alive()
+        assert not service._event_loop_thread.is_alive()
+        assert not service._event_loop.is_running()
+        assert service.repository.closed
+
+    def test_stop_finishes_when_ble_cleanup_fails(self, service, ble_calls):
+        async def stop():
+            raise RuntimeError("adapter gone")
+
+        service.ble_manager.stop = stop
+        service.start()
+        service.stop()
+        assert not service._event_loop_thread.is_alive()
+        assert service.repository.closed
+
+    def test_stop_before_start_closes_repository(self, service):
+        service.stop()
+        assert service.repository.closed
+
+    def test_static_responses_are_packed_once(self, repository):
+        service = Service(FakeFrontend(), repository, finish="tan")
+        response = service.get_hardware_finish()
+        assert service.get_hardware_finish() is response
+        assert HardwareFinishResponse.unpack(unpack_from_base64_string(response)).color == HardwareFinishColor.TAN
+        configuration = SupportedConfigurationResponse.unpack(
+            unpack_from_base64_string(service.get_nfc_access_supported_configuration())
+        )
+        assert configuration.number_of_issuer_keys == 16
+        assert configuration.number_of_inactive_credentials == 16
+
+    def test_unsupported_finish_falls_back_to_black(self, repository):
+        service = Service(FakeFrontend(), repository, finish="purple")
+        response = HardwareFinishResponse.unpack(unpack_from_base64_string(service.get_hardware_finish()))
+        assert response.color == HardwareFinishColor.BLACK
+
+    def test_control_point_adds_and_gets_reader_key(self, service, repository):
+        reader_private_key, reader_identifier = os.urandom(32), os.urandom(8)
+        request = ControlPointRequest(
+            operation=Operation.ADD,
+            reader_key_request=ReaderKeyRequest(
+                key_type=KeyType.SECP256R1,
+                reader_private_key=reader_private_key,
+                unique_reader_identifier=reader_identifier,
+                key_identifier=os.urandom(8),
+            ),
+        )
+        assert control_point(service, request).reader_key_response is not None
+        assert repository.get_reader_private_key() == reader_private_key
+        assert repository.get_reader_identifier() == reader_identifier
+        response = control_point(
+            service, ControlPointRequest(operation=Operation.GET, reader_key_request=ReaderKeyRequest())
+        )
+        assert response.reader_key_response.key_identifier == repository.get_reader_group_identifier()
+
+    def test_control_point_adds_device_credential(self, service, repository):
+        issuer = Issuer(public_key=os.urandom(32), endpoints=[])
+        repository.upsert_issuer(issuer)
+        credential_public_key = os.urandom(64)
+        request = ControlPointRequest(
+            operation=Operation.ADD,
+            device_credential_request=DeviceCredentialRequest(
+                key_type=KeyType.SECP256R1,
+                credential_public_key=credential_public_key,
+                issuer_key_identifier=issuer.id,
+                key_state=KeyState.ACTIVE,
+            ),
+        )
+        response = control_point(service, request).device_credential_response
+        assert response.issuer_key_identifier == issuer.id
+        assert response.status == OperationStatus.DUPLICATE
+        endpoint = repository.get_endpoint_by_public_key(b"\x04" + credential_public_key)
+        assert endpoint.enrollments.hap is not None
+        assert repository.get_issuer_by_endpoint(endpoint).id == issuer.id
+
+    def test_update_hap_pairings_applies_differences(self, service, repository):
+        kept = Issuer(public_key=os.urandom(32), endpoints=[make_endpoint()])
+        removed = Issuer(public_key=os.urandom(32), endpoints=[])
+        repository.upsert_issuers([kept, removed])
+        added_public_key = os.urandom(32)
+        service.update_hap_pairings([kept.public_key, added_public_key, added_public_key])
+        assert {i.public_key for i in repository.get_all_issuers()} == {kept.public_key, added_public_key}
+        assert repository.get_issuer_by_id(kept.id) == kept
+        assert len(repository.changes) == 1
+
+    def test_update_hap_pairings_without_differences_saves_nothing(self, service, repository):
+        issuer = Issuer(public_key=os.urandom(32), endpoints=[])
+        repository.upsert_issuer(issuer)
+        service.update_hap_pairings([issuer.public_key])
+        assert repository.changes == []
@@ -0,0 +1,19 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def loads(data):
+    # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)